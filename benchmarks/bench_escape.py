@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Compares `Query._escape` against the character by character escaper
+we used to have
+
+Run it with `make benchmark`. Before timing anything it checks that both
+escapers produce the same output for a few thousand random strings.
+"""
+from __future__ import print_function, unicode_literals
+
+import random
+import timeit
+
+from elasticfun.query import ESCAPE_CHARS, Query
+
+
+def reference(s):
+    r = []
+    for c in s:
+        if c in ESCAPE_CHARS:
+            r.append('\\')
+        r.append(c)
+    return ''.join(r)
+
+
+def check(escape):
+    rand = random.Random(0)
+    alphabet = 'abc 123é' + ESCAPE_CHARS
+    for _ in range(5000):
+        s = ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 50)))
+        assert escape(s) == reference(s), s
+
+
+def main():
+    escape = Query('')._escape
+    check(escape)
+
+    inputs = [
+        ('short word', 'cream'),
+        ('user input', 'fitness accessories (men) for running: shoes! ' * 4),
+        ('long text', 'lorem ipsum dolor sit amet ' * 400),
+        ('long special', 'a-b:c/d ' * 1000),
+    ]
+    print('{:>14} {:>8} {:>16} {:>16}'.format(
+        'input', 'length', 'reference (us)', 'escape (us)'))
+    for name, s in inputs:
+        runs = max(10, 200000 // len(s))
+        old = timeit.timeit(lambda: reference(s), number=runs)
+        new = timeit.timeit(lambda: escape(s), number=runs)
+        print('{:>14} {:>8} {:>16.2f} {:>16.2f}'.format(
+            name, len(s), old / runs * 1e6, new / runs * 1e6))
+
+
+if __name__ == '__main__':
+    main()
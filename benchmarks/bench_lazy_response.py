@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Compares the decoders of `elasticfun.response` on a 1 MB response
+
+Run it with `make benchmark`. The response is made up with a fixed seed,
+with the shape of a search returning 1000 hits, and each decoder reads
+the `_type` and `_id` of every hit, which is what most wrappers need.
+`lazy_loads()` only differs from `loads()` when `pysimdjson` is
+installed.
+
+The peak memory is measured in a fresh process for each decoder, using
+`/proc/self/statm` along with `tracemalloc`, since simdjson allocates
+its buffers outside of the python allocator. It only runs on Linux.
+"""
+from __future__ import print_function, unicode_literals
+
+import json
+import os
+import random
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from elasticfun import response
+
+HITS = 1000
+ROUNDS = 20
+
+
+def make_response():
+    rand = random.Random(0)
+    words = ['ice', 'cream', 'chocolate', 'vanilla', 'cone', 'scoop', 'sugar']
+
+    def text(size):
+        return ' '.join(rand.choice(words) for _ in range(size))
+
+    hits = [{
+        '_index': 'default',
+        '_type': rand.choice(['user', 'deal']),
+        '_id': str(i),
+        '_score': rand.random(),
+        '_source': {
+            'title': text(8),
+            'description': text(120),
+            'tags': [rand.choice(words) for _ in range(10)],
+            'price': rand.randint(1, 1000),
+            'location': {'lat': rand.random(), 'lon': rand.random()},
+        },
+    } for i in range(HITS)]
+    raw = {'took': 12, 'timed_out': False,
+           'hits': {'total': HITS, 'max_score': 1.0, 'hits': hits}}
+    return json.dumps(raw).encode('utf-8')
+
+
+def stdlib_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+
+DECODERS = [
+    ('json', stdlib_loads),
+    ('loads', response.loads),
+    ('lazy_loads', response.lazy_loads),
+]
+
+
+def read_keys(decode, data):
+    hits = decode(data)['hits']['hits']
+    return [(hit['_type'], hit['_id']) for hit in hits]
+
+
+def resident():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_memory(name):
+    # Runs in its own process, see `main()`. We report both the peak seen
+    # by tracemalloc and the growth of the resident memory, since
+    # simdjson keeps its document outside of python
+    decode = dict(DECODERS)[name]
+    data = sys.stdin.buffer.read()
+    before = resident()
+    tracemalloc.start()
+    decoded = decode(data)
+    keys = [(hit['_type'], hit['_id']) for hit in decoded['hits']['hits']]
+    traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert len(keys) == HITS
+    print(traced // 1024, (resident() - before) // 1024)
+
+
+def main():
+    data = make_response()
+    expected = read_keys(stdlib_loads, data)
+    print('{:.2f} MB, {} hits, orjson {}, simdjson {}'.format(
+        len(data) / 1024.0 / 1024, HITS,
+        response.orjson and 'on' or 'off',
+        response.simdjson and 'on' or 'off'))
+
+    for name, decode in DECODERS:
+        assert read_keys(decode, data) == expected, name
+        seconds = min(timeit.repeat(
+            lambda: read_keys(decode, data), number=ROUNDS, repeat=3))
+        process = subprocess.Popen(
+            [sys.executable, __file__, name],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        traced, grown = process.communicate(data)[0].decode('utf-8').split()
+        print('{:>12} {:>8.2f} ms {:>8} KB traced {:>8} KB resident'.format(
+            name, seconds / ROUNDS * 1000, traced, grown))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        peak_memory(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Compares the flattened output of `Query` against the nested one
+
+Run it with `make benchmark`. For each chain size it prints the time
+taken to serialize the query, the size of the output and the nesting
+depth, for both the flattened groups and the nested binary groups we
+used to generate.
+"""
+from __future__ import print_function, unicode_literals
+
+import operator
+import timeit
+from functools import reduce
+
+from six import text_type
+
+from elasticfun import Query
+
+
+def nested(query):
+    # The previous output: one pair of parenthesis per binary operation
+    parts, stack = [], [query]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, Query):
+            parts.append(item)
+        elif item.op is None:
+            parts.append(text_type(item))
+        elif item.op == 'NOT':
+            stack.extend([')', item.children[0], '(NOT '])
+        else:
+            left, right = item.children
+            stack.extend([')', right, ' {} '.format(item.op), left, '('])
+    return ''.join(parts)
+
+
+def flattened(query):
+    return query._serialize()
+
+
+def depth(output):
+    # Deepest nesting of the parenthesis outside of the quoted terms
+    deepest = current = 0
+    quoted = escaped = False
+    for char in output:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            current += 1
+            deepest = max(deepest, current)
+        elif char == ')':
+            current -= 1
+    return deepest
+
+
+def main():
+    print('{:>6} {:>12} {:>12} {:>10} {:>10} {:>7}'.format(
+        'terms', 'nested (ms)', 'flat (ms)', 'nested', 'flat', 'depth'))
+    for size in (10, 100, 1000, 10000):
+        query = reduce(operator.and_, [
+            Query(tag='tag{}'.format(i)) for i in range(size)])
+
+        # Warming up the leaves cache so we only measure the grouping
+        nested(query)
+        runs = max(1, 2000 // size)
+        nested_time = timeit.timeit(lambda: nested(query), number=runs)
+        flat_time = timeit.timeit(lambda: flattened(query), number=runs)
+        nested_output, flat_output = nested(query), flattened(query)
+
+        print('{:>6} {:>12.3f} {:>12.3f} {:>10} {:>10} {:>7}'.format(
+            size,
+            nested_time / runs * 1000,
+            flat_time / runs * 1000,
+            len(nested_output),
+            len(flat_output),
+            '{}/{}'.format(depth(nested_output), depth(flat_output))))
+
+
+if __name__ == '__main__':
+    main()
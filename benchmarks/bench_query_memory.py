@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Measures how much memory each node of a big query takes
+
+Run it with `make benchmark`. It builds an OR group of 100k tag queries
+with `tracemalloc` running and compares the bytes per node of `Query`
+against an object holding the same attributes in a regular `__dict__`,
+the way queries used to be stored.
+"""
+from __future__ import print_function, unicode_literals
+
+import gc
+import tracemalloc
+
+from elasticfun import Query
+
+TERMS = 100000
+
+
+class DictQuery(object):
+    def __init__(self, field, query):
+        self.boost = None
+        self._empty = False
+        self.op = None
+        self.children = ()
+        self._key = None
+        self.field = field
+        self.lookup = None
+        self.query = query
+
+
+def measure(build):
+    # The values are created beforehand so we only count the nodes
+    values = ['tag{}'.format(i) for i in range(TERMS)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = build(values)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del nodes
+    return (after - before) / float(TERMS + 1)
+
+
+def build_query(values):
+    return Query._group('OR', [Query(tag=value) for value in values])
+
+
+def build_dict_query(values):
+    leaves = [DictQuery(str('tag'), value) for value in values]
+    node = DictQuery(None, None)
+    node.op, node.children = 'OR', tuple(leaves)
+    return node
+
+
+def main():
+    dict_bytes = measure(build_dict_query)
+    slots_bytes = measure(build_query)
+    print('{} terms'.format(TERMS))
+    print('{:>20} {:>8.1f} bytes per node'.format('with __dict__', dict_bytes))
+    print('{:>20} {:>8.1f} bytes per node'.format('with __slots__', slots_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from .cache import SearchCache  # noqa
+from .connections import ClientRegistry  # noqa
 from .exceptions import (  # noqa
     ConfigMissingException,
     ImproperlyConfigured,
     ParsingException,
     EmptyQuerySetException
 )
+from .indexer import Indexer  # noqa
 from .query import Query  # noqa
 from .queryset import QuerySet  # noqa
-from .wrappers import Wrapper  # noqa
+from .singleflight import SingleFlight  # noqa
+from .wrappers import CachedWrapper, Wrapper  # noqa
 
 
 __version__ = '0.3.1'
 
 __all__ = (
+    'CachedWrapper',
+    'ClientRegistry',
     'ConfigMissingException',
     'EmptyQuerySetException',
     'ImproperlyConfigured',
+    'Indexer',
     'ParsingException',
     'Query',
     'QuerySet',
+    'SearchCache',
+    'SingleFlight',
     'Wrapper'
 )
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from datetime import datetime, timedelta
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from six import string_types
+
+KINDS = ('terms', 'range', 'date_histogram')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def aggregation_body(name, terms=None, range=None, date_histogram=None,
+                     **options):
+    """Builds the body of the `name` aggregation. Its kind is given as a
+    field name or the whole dict ES expects, and the `options` are added
+    to it, e.g. `terms='tags', size=20`"""
+    kinds = [
+        (kind, spec) for kind, spec in zip(
+            KINDS, (terms, range, date_histogram)) if spec is not None
+    ]
+    if len(kinds) != 1:
+        raise ValueError(
+            'The aggregation `{}` needs exactly one of: {}'.format(
+                name, ', '.join(KINDS)))
+
+    kind, spec = kinds[0]
+    body = {'field': spec} if isinstance(spec, string_types) else dict(spec)
+    body.update(options)
+    return {kind: body}
+
+
+class Bucket(object):
+    """A bucket of a `terms` aggregation. The response of ES for it is kept
+    in `data`, which also holds the results of any sub aggregation."""
+
+    __slots__ = ('key', 'count', 'data')
+
+    def __init__(self, data):
+        self.key = data.get('key')
+        self.count = data.get('doc_count', 0)
+        self.data = data
+
+    def __repr__(self):
+        return '<{} {!r}: {}>'.format(self.__class__.__name__, self.key, self.count)
+
+
+class RangeBucket(Bucket):
+    """A bucket of a `range` aggregation, from `start` to `end`. Either of
+    them is None when the range is open on that side."""
+
+    __slots__ = ('start', 'end')
+
+    def __init__(self, data):
+        super(RangeBucket, self).__init__(data)
+        self.start = data.get('from')
+        self.end = data.get('to')
+
+
+class DateBucket(Bucket):
+    """A bucket of a `date_histogram` aggregation. ES sends its key as
+    milliseconds since the epoch, we turn it into a naive UTC datetime."""
+
+    __slots__ = ()
+
+    def __init__(self, data):
+        super(DateBucket, self).__init__(data)
+        if self.key is not None:
+            self.key = EPOCH + timedelta(milliseconds=self.key)
+
+
+BUCKETS = {'terms': Bucket, 'range': RangeBucket, 'date_histogram': DateBucket}
+
+
+class Aggregation(object):
+    """The result of an aggregation, its buckets are only built when
+    they're first used"""
+
+    def __init__(self, name, kind, data):
+        self.name = name
+        self.kind = kind
+        self.data = data
+        self._buckets = None
+
+    @property
+    def buckets(self):
+        if self._buckets is None:
+            bucket = BUCKETS.get(self.kind, Bucket)
+            buckets = self.data.get('buckets', [])
+            # Keyed ranges come as a dict of buckets
+            if isinstance(buckets, dict):
+                buckets = [
+                    dict(value, key=key) for key, value in buckets.items()]
+            self._buckets = [bucket(data) for data in buckets]
+        return self._buckets
+
+    def counts(self):
+        return dict((bucket.key, bucket.count) for bucket in self.buckets)
+
+    def __iter__(self):
+        return iter(self.buckets)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __repr__(self):
+        return '<Aggregation {} ({})>'.format(self.name, self.kind)
+
+
+class Aggregations(Mapping):
+    """The aggregations of a search response, by name. Each of them is
+    parsed when it's first accessed."""
+
+    def __init__(self, data, kinds=None):
+        self.data = data
+        self.kinds = kinds or {}
+        self._parsed = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._parsed[name]
+        except KeyError:
+            aggregation = self._parsed[name] = Aggregation(
+                name, self.kinds.get(name), self.data[name])
+            return aggregation
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
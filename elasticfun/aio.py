@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""asyncio version of the QuerySet
+
+It talks to the cluster through aiohttp instead of pyelasticsearch, so
+many searches can share a single event loop without blocking it. The
+`aiohttp` package must be installed to use this module, which needs
+python 3.7 or later.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import inspect
+import json
+from urllib.parse import quote
+
+import aiohttp
+import pyelasticsearch
+from six import string_types
+
+from .exceptions import EmptyQuerySetException
+from .queryset import QuerySet, search_key, search_query, _hydrate, _to_json
+from .response import loads, lazy_loads
+from .wrappers import CachedWrapper
+
+# Holding the background refreshes of the cache, asyncio only keeps weak
+# references to its tasks
+_refreshes = set()
+
+
+def _to_query(value):
+    # The same conversions pyelasticsearch does to the values of the
+    # query string parameters
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, (list, tuple)):
+        return ','.join(_to_query(item) for item in value)
+    return str(value)
+
+
+class AsyncClient(object):
+
+    def __init__(self, url, session, lazy=False):
+        self.url = url.rstrip('/')
+        self.session = session
+        self.decode = lazy and lazy_loads or loads
+
+    async def send_request(self, method, path_components, body='',
+                           query_params=None, encode_body=True):
+        path = '/'.join(
+            quote(str(component), '')
+            for component in path_components if component)
+        params = dict(
+            (key, _to_query(value))
+            for key, value in (query_params or {}).items())
+        headers = {}
+        if body and encode_body:
+            body = json.dumps(body, default=_to_json)
+        if body:
+            headers['Content-Type'] = 'application/json'
+
+        url = '{}/{}'.format(self.url, path)
+        async with self.session.request(
+                method, url, params=params, data=body or None,
+                headers=headers) as response:
+            data = await response.read()
+
+        payload = self.decode(data) if data else None
+
+        if response.status >= 400:
+            error = isinstance(payload, dict) and payload.get('error') or payload
+            raise pyelasticsearch.ElasticHttpError(response.status, error)
+        return payload
+
+    async def search(self, query, index=None, **kwargs):
+        return await self._search_or_count('_search', query, index, kwargs)
+
+    async def count(self, query, index=None, **kwargs):
+        return await self._search_or_count('_count', query, index, kwargs)
+
+    async def _search_or_count(self, kind, query, index, kwargs):
+        # Following pyelasticsearch here, strings go in the `q` parameter
+        # and everything else is sent as the request body
+        query_params = dict(
+            (key[3:], value) for key, value in kwargs.items()
+            if key.startswith('es_'))
+        body = ''
+        if isinstance(query, string_types):
+            query_params['q'] = query
+        else:
+            body = query
+        return await self.send_request(
+            'GET', [index, kind], body, query_params)
+
+
+class AsyncClientRegistry(object):
+    """Keeps one aiohttp session per connection URL and event loop"""
+
+    def __init__(self, maxsize=10, idle_timeout=300, lazy=False):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.lazy = lazy
+        self._clients = {}
+
+    def get(self, url):
+        loop = asyncio.get_running_loop()
+        # Sessions can't outlive their loop, and holding them would keep
+        # the loops that are already closed around
+        for key in list(self._clients):
+            if key[1].is_closed():
+                del self._clients[key]
+
+        client = self._clients.get((url, loop))
+        if client is None or client.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.maxsize, keepalive_timeout=self.idle_timeout)
+            session = aiohttp.ClientSession(connector=connector)
+            client = self._clients[url, loop] = AsyncClient(
+                url, session, lazy=self.lazy)
+        return client
+
+    async def close(self, url=None):
+        loop = asyncio.get_running_loop()
+        for key in list(self._clients):
+            if key[1] is loop and (url is None or key[0] == url):
+                await self._clients.pop(key).session.close()
+
+
+_registry = None
+
+
+def default_registry():
+    """The registry shared by the querysets created without one, so they
+    all reuse the same sessions"""
+    global _registry
+    if _registry is None:
+        _registry = AsyncClientRegistry()
+    return _registry
+
+
+class AsyncSingleFlight(object):
+    """The asyncio version of `elasticfun.SingleFlight`: coroutines
+    awaiting `do()` with a key that's already in flight wait for the
+    running call instead of starting a new one"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, function, *args, **kwargs):
+        key = (key, asyncio.get_running_loop())
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(
+                function(*args, **kwargs))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # Shielding the shared task, so a waiter being cancelled doesn't
+        # cancel the request for everybody else
+        return await asyncio.shield(task)
+
+
+class AsyncCachedWrapper(CachedWrapper):
+    """The `CachedWrapper` of wrappers whose `wrap()` is a coroutine. Its
+    own `wrap()` is a coroutine as well, so it only works with async
+    querysets."""
+
+    async def wrap(self, hits):
+        keys, cached, misses = self._lookup(hits)
+        fresh = misses and self.wrapper.wrap(misses) or []
+        if inspect.isawaitable(fresh):
+            fresh = await fresh
+        return self._store(keys, cached, fresh)
+
+
+class AsyncQuerySet(QuerySet):
+    """A QuerySet whose `search()`, `msearch()`, `count()` and `items()`
+    methods are coroutines, and whose `iter_items()` and `iter_all()` methods are
+    iterated with `async for`. The `wrap()` method of the wrappers may be a coroutine
+    as well, in which case they all run concurrently. Regular wrappers
+    run in the `executor`, when one is given."""
+
+    def __init__(self, conf=None, registry=None, executor=None, cache=None,
+                 singleflight=None):
+        registry = registry or default_registry()
+        super(AsyncQuerySet, self).__init__(
+            conf=conf, registry=registry, executor=executor, cache=cache,
+            singleflight=singleflight)
+
+    async def search(self, query, index='default', filter=None,
+                     count_only=False, **kwargs):
+        # Looking up the index
+        if index not in self.conf.indexes:
+            self.raise_improperly_configured(index=index)
+
+        esinst = self.get_client(index)
+
+        query = search_query(query, filter, self.aggs)
+        if count_only:
+            kwargs['es_size'] = 0
+        kwargs = self._source_kwargs(kwargs)
+        self._result_cache = None
+        if self.cache is None:
+            self.raw_results = await self._backend_search(
+                esinst, query, index, kwargs)
+        else:
+            self.raw_results = await self._cached_search(
+                esinst, query, index, kwargs)
+
+        return self
+
+    async def _cached_search(self, esinst, query, index, kwargs):
+        key = self.cache.entry_key(index, search_key(query, kwargs))
+        raw_results, stale = self.cache.get(key)
+        if raw_results is None:
+            raw_results = await self._backend_search(
+                esinst, query, index, kwargs)
+            self.cache.set(key, raw_results)
+        elif stale and self.cache.claim(key):
+            task = asyncio.ensure_future(
+                self._refresh(esinst, query, index, kwargs, key))
+            _refreshes.add(task)
+            task.add_done_callback(_refreshes.discard)
+        return raw_results
+
+    async def _refresh(self, esinst, query, index, kwargs, key):
+        try:
+            raw_results = await self._backend_search(
+                esinst, query, index, kwargs)
+            self.cache.set(key, raw_results)
+        finally:
+            self.cache.release(key)
+
+    async def _backend_search(self, esinst, query, index, kwargs):
+        if self.singleflight is None:
+            return await esinst.search(query, index=index, **kwargs)
+        key = (index,) + search_key(query, kwargs)
+        return await self.singleflight.do(
+            key, esinst.search, query, index=index, **kwargs)
+
+    async def count(self, *args, **kwargs):
+        # Counting the hits of the last search doesn't need a request, but
+        # we still return a coroutine, so callers always await `count()`
+        count = super(AsyncQuerySet, self).count(*args, **kwargs)
+        if inspect.isawaitable(count):
+            count = await count
+        return count
+
+    async def _count(self, query=None, index='default', filter=None, **kwargs):
+        if index not in self.conf.indexes:
+            self.raise_improperly_configured(index=index)
+
+        esinst = self.get_client(index)
+        query = search_query(query, filter)
+        if not query:
+            query = {'query': {'match_all': {}}}
+        response = await esinst.count(query, index=index, **kwargs)
+        return response['count']
+
+    async def msearch(self, searches):
+        # The requests to different clusters run concurrently
+        groups = list(self._group_searches(searches).items())
+        responses = await asyncio.gather(*[
+            self.registry.get(url).send_request(
+                'GET', ['_msearch'], self._msearch_body(searches, positions),
+                encode_body=False)
+            for url, positions in groups
+        ])
+
+        results = [None] * len(searches)
+        for (url, positions), response in zip(groups, responses):
+            self._collect_responses(results, positions, response)
+        return results
+
+    async def items(self, clean=True):
+        hits = self._hits()
+        if not self.wrappers:
+            return hits
+        return await self._wrap_hits(hits, clean)
+
+    async def _iter_chunks(self, hits, chunk_size, clean):
+        # `iter_items()` returns this generator as it is
+        for start in range(0, len(hits), chunk_size):
+            chunk = hits[start:start + chunk_size]
+            if self.wrappers:
+                chunk = await self._wrap_hits(chunk, clean)
+            for item in chunk:
+                yield item
+
+    async def _scroll(self, query, index, scroll, clean, kwargs):
+        # `iter_all()` returns this generator as it is
+        esinst = self.get_client(index)
+        raw_results = await esinst.search(query, index=index, **kwargs)
+        scroll_id = raw_results.get('_scroll_id')
+        try:
+            while raw_results['hits']['hits']:
+                hits = raw_results['hits']['hits']
+                async for item in self._iter_chunks(hits, len(hits), clean):
+                    yield item
+                raw_results = await esinst.send_request(
+                    'GET', ['_search', 'scroll'], scroll_id,
+                    query_params={'scroll': scroll}, encode_body=False)
+                scroll_id = raw_results.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    await esinst.send_request(
+                        'DELETE', ['_search', 'scroll', scroll_id])
+                except pyelasticsearch.ElasticHttpError:
+                    pass
+
+    async def _wrap_hits(self, hits, clean):
+        _order_dict, _type_dict = self._group_hits(hits)
+        wrappers = list(_type_dict)
+        wrapped_hits = await asyncio.gather(*[
+            self._hydrate(wrapper, _type_dict[wrapper]) for wrapper in wrappers
+        ])
+        wrapped = list(zip(wrappers, wrapped_hits))
+        return self._merge_wrapped(hits, _order_dict, wrapped, clean)
+
+    async def fetch(self):
+        """Runs the search built by `query()`, `filter()` and the other
+        lazy methods, unless it already ran, and wraps its hits. After
+        that, `len()`, `bool()` and indexing work on the results"""
+        if self._lazy and self.raw_results is None:
+            query, index, filter, kwargs = self._lazy_search()
+            await self.search(query, index=index, filter=filter, **kwargs)
+        if self._result_cache is None:
+            self._result_cache = await self.items()
+        return self
+
+    async def __aiter__(self):
+        await self.fetch()
+        for item in self._result_cache:
+            yield item
+
+    def _execute(self):
+        if self._lazy and self.raw_results is None:
+            raise EmptyQuerySetException(
+                'This QuerySet did not run yet. Use `await queryset.fetch()` '
+                'or `async for` to run its search.')
+
+    def _results(self):
+        # `__len__()`, `__bool__()` and `__getitem__()` read the results
+        # through here, and we can't wrap the hits without awaiting
+        if self._result_cache is None:
+            raise TypeError(
+                'The results of async querysets are read after '
+                '`await queryset.fetch()` or with `async for`.')
+        return self._result_cache
+
+    async def _hydrate(self, wrapper, typed_results):
+        if self.executor is not None and \
+                not asyncio.iscoroutinefunction(wrapper.wrap):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, _hydrate, wrapper, typed_results)
+
+        wrapped_hits = wrapper.wrap(typed_results)
+        if inspect.isawaitable(wrapped_hits):
+            wrapped_hits = await wrapped_hits
+        return wrapped_hits
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+import threading
+import time
+from collections import defaultdict, OrderedDict
+
+
+class LRUCache(object):
+    """A thread safe mapping that keeps at most `maxsize` items, dropping
+    the least recently used ones first. When `ttl` is given, items also
+    expire after that many seconds. When `maxweight` is given, the total
+    `weight()` of the values is kept under it as well, and values heavier
+    than that on their own aren't kept at all.
+
+    Besides the usual `get()`/`set()`, it implements `get_many()`,
+    `set_many()` and `delete()`, which is all the API the caches of the
+    wrappers and querysets need from a backend.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxweight=None, weight=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weight = weight
+        self._data = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, _MISSING)
+                if value is not _MISSING:
+                    found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = ttl or self.ttl
+        expires = ttl and time.time() + ttl
+        with self._lock:
+            for key, value in mapping.items():
+                self._pop(key)
+                if self.maxweight is not None:
+                    weight = self.weight(value)
+                    if weight > self.maxweight:
+                        continue
+                    self._weight += weight
+                self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize or (
+                    self.maxweight is not None and self._weight > self.maxweight):
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def _get(self, key, default):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires and expires <= time.time():
+            if self.maxweight is not None:
+                self._weight -= self.weight(value)
+            return default
+        self._data[key] = (value, expires)
+        return value
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None and self.maxweight is not None:
+            self._weight -= self.weight(entry[0])
+
+
+class SearchCache(object):
+    """Keeps the decoded responses of `QuerySet.search()`, so repeated
+    searches skip both the HTTP round trip and the JSON parsing.
+
+    Responses are fresh for `ttl` seconds. For `stale_ttl` more seconds
+    they're still served, but the first search hitting a stale response
+    also refreshes it in the background. Responses are shared between
+    querysets, so they must not be changed in place.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, stale_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl + stale_ttl)
+        self._generation = 0
+        self._generations = defaultdict(int)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def entry_key(self, index, key):
+        """The key of a search in the current generation of `index`. It's
+        taken before searching and passed to the other methods, so the
+        responses of searches started before `invalidate()` are never
+        stored as fresh ones."""
+        return (index, self._generation, self._generations[index], key)
+
+    def get(self, entry_key):
+        """Returns a `(raw_results, stale)` tuple, `raw_results` being
+        None when there's nothing cached for the search"""
+        entry = self._cache.get(entry_key)
+        if entry is None:
+            return None, False
+        raw_results, fresh_until = entry
+        return raw_results, fresh_until <= time.time()
+
+    def set(self, entry_key, raw_results):
+        self._cache.set(entry_key, (raw_results, time.time() + self.ttl))
+
+    def invalidate(self, index=None):
+        # Instead of looking for the keys of an index, we just move it to
+        # a new generation. The old entries are never read again and
+        # leave the cache as it evicts them. Invalidating everything also
+        # moves every index to a new generation, so the searches in
+        # flight don't store their responses as fresh ones afterwards
+        with self._lock:
+            if index is None:
+                self._generation += 1
+                self._cache.clear()
+            else:
+                self._generations[index] += 1
+
+    def claim(self, entry_key):
+        """Returns True if the caller should refresh the search, which
+        happens for a single caller at a time"""
+        with self._lock:
+            if entry_key in self._refreshing:
+                return False
+            self._refreshing.add(entry_key)
+            return True
+
+    def release(self, entry_key):
+        with self._lock:
+            self._refreshing.discard(entry_key)
+
+
+_MISSING = object()
@@ -10,6 +10,8 @@ class UnicodeMixin(object):
     """Mixin class to handle defining the proper __str__/__unicode__
     methods in Python 2 or 3."""
 
+    __slots__ = ()
+
     if six.PY3:
         def __str__(self):
             return self.__unicode__()
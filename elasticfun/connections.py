@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+import threading
+import time
+import warnings
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+
+import pyelasticsearch
+from requests.adapters import HTTPAdapter
+
+from .response import lazy_loads
+
+
+def send_encoded(client, method, path_components, body, query_params=None):
+    """Sends a body that is already encoded, like the lines of `_bulk` and
+    `_msearch` requests. pyelasticsearch 0.4 encodes every body as JSON
+    unless told not to, while the later versions send strings as they
+    are and don't take the `encode_body` argument."""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    if 'encode_body' in getargspec(client.send_request).args:
+        return client.send_request(
+            method, path_components, body, query_params, encode_body=False)
+    return client.send_request(method, path_components, body, query_params)
+
+
+def _decode_response(response):
+    # Same as the `_decode_response()` method of the clients, using the
+    # decoder of lazy responses
+    try:
+        return lazy_loads(response.content)
+    except ValueError:
+        raise pyelasticsearch.InvalidJsonResponseError(response)
+
+
+class _LazySerializer(object):
+    # Takes the place of the JSON serializer of the elasticsearch-py
+    # transport the clients of pyelasticsearch 1.x talk through
+
+    mimetype = 'application/json'
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+    def dumps(self, data):
+        return self.serializer.dumps(data)
+
+    def loads(self, s):
+        try:
+            return lazy_loads(s)
+        except ValueError:
+            # Letting the original serializer raise the error the client
+            # expects
+            return self.serializer.loads(s)
+
+
+class ClientRegistry(object):
+    """Keeps one pyelasticsearch client per connection URL
+
+    Each client holds a keep-alive HTTP session, so reusing them saves us
+    from paying the TCP/TLS setup on every single search. Clients that
+    stay idle for longer than `idle_timeout` seconds are closed and
+    created again on the next use, since the server has probably dropped
+    their sockets already.
+
+    With `lazy=True` the responses are decoded by
+    `elasticfun.response.lazy_loads()`, so the hits are only decoded as
+    they're used.
+
+    Lazy decoding works with the clients of pyelasticsearch 0.4 and 1.x.
+    The pool size and `close()` work on the `requests` session of the
+    pyelasticsearch 0.4 clients. Later versions don't expose it, so we
+    warn when creating one of their clients, which keeps its own pool.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=300, lazy=False):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.lazy = lazy
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        now = time.time()
+        with self._lock:
+            client, last_used = self._clients.get(url, (None, None))
+            if client is not None and self._expired(last_used, now):
+                self._close_client(client)
+                client = None
+            if client is None:
+                client = self._create_client(url)
+            self._clients[url] = (client, now)
+        return client
+
+    def warm(self, connections):
+        # Opening the clients for all the entries of a `conf.connections`
+        # dict beforehand, so the first request doesn't pay for it
+        for connection in connections.values():
+            self.get(connection['URL'])
+
+    def close(self, url=None):
+        with self._lock:
+            urls = [url] if url else list(self._clients)
+            for key in urls:
+                client, _ = self._clients.pop(key, (None, None))
+                if client is not None:
+                    self._close_client(client)
+
+    def _expired(self, last_used, now):
+        return self.idle_timeout is not None and \
+            now - last_used > self.idle_timeout
+
+    def _create_client(self, url):
+        client = pyelasticsearch.ElasticSearch(url)
+
+        # The client talks to the cluster through a `requests` session,
+        # so we just need to give it a pool of the size we were asked
+        session = getattr(client, 'session', None)
+        if session is None:
+            warnings.warn(
+                'The pyelasticsearch client has no `session`, so `maxsize` and '
+                '`close()` have no effect. elasticfun needs pyelasticsearch 0.4.',
+                RuntimeWarning)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        if self.lazy:
+            self._decode_lazily(client)
+        return client
+
+    def _decode_lazily(self, client):
+        deserializer = getattr(
+            getattr(client, '_transport', None), 'deserializer', None)
+        if hasattr(client, '_decode_response'):
+            client._decode_response = _decode_response
+        elif deserializer is not None:
+            lazy = _LazySerializer(deserializer.serializers[_LazySerializer.mimetype])
+            if deserializer.default is lazy.serializer:
+                deserializer.default = lazy
+            deserializer.serializers[lazy.mimetype] = lazy
+        else:
+            warnings.warn(
+                "The pyelasticsearch client can't be told how to decode the "
+                "responses, so `lazy` has no effect.", RuntimeWarning)
+
+    def _close_client(self, client):
+        session = getattr(client, 'session', None)
+        if session is not None:
+            session.close()
+
+
+_registry = None
+
+
+def default_registry():
+    """The registry shared by the querysets and indexers created without
+    one, so they all reuse the same clients"""
+    global _registry
+    if _registry is None:
+        _registry = ClientRegistry()
+    return _registry
@@ -4,10 +4,15 @@ from __future__ import unicode_literals
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from ..connections import ClientRegistry
+from ..indexer import Indexer as ElasticFunIndexer
 from ..queryset import QuerySet as ElasticFunQuerySet
 
 
 class ConfManager(object):
+
+    _registry = None
+
     @property
     def connections(self):
         return settings.ELASTICFUN_CONNECTIONS
@@ -16,12 +21,40 @@ class ConfManager(object):
     def indexes(self):
         return list(self.connections.keys())
 
+    @property
+    def registry(self):
+        # All the ConfManager instances share the same registry, so the
+        # connections opened by a web worker outlive each request
+        if ConfManager._registry is None:
+            options = getattr(settings, 'ELASTICFUN_POOL', {})
+            ConfManager._registry = ClientRegistry(**options)
+        return ConfManager._registry
+
 
 class QuerySet(ElasticFunQuerySet):
 
-    def __init__(self, conf=None):
+    def __init__(self, conf=None, registry=None, executor=None, cache=None,
+                 singleflight=None):
+        conf = conf or ConfManager()
+        registry = registry or getattr(conf, 'registry', None)
+        super(QuerySet, self).__init__(
+            conf=conf, registry=registry, executor=executor, cache=cache,
+            singleflight=singleflight)
+
+    def raise_improperly_configured(self, index=None):
+        raise ImproperlyConfigured((
+            "There's no index called `{}`, the available ones are: {}. "
+            "Check the ELASTICFUN_CONNECTIONS variable in your settings "
+            "file."
+        ).format(index, ', '.join(self.conf.indexes)))
+
+
+class Indexer(ElasticFunIndexer):
+
+    def __init__(self, conf=None, registry=None, **kwargs):
         conf = conf or ConfManager()
-        super(QuerySet, self).__init__(conf=conf)
+        registry = registry or getattr(conf, 'registry', None)
+        super(Indexer, self).__init__(conf=conf, registry=registry, **kwargs)
 
     def raise_improperly_configured(self, index=None):
         raise ImproperlyConfigured((
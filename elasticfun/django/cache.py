@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+
+class DjangoCache(object):
+    """Adapts one of the caches declared in the `CACHES` setting to the
+    backend API used by `elasticfun.CachedWrapper`"""
+
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping, ttl=None):
+        if mapping:
+            self.cache.set_many(mapping, timeout=ttl or self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
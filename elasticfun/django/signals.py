@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Keeps the indexes up to date with the saves and deletes of models
+
+Models are registered with a function building their documents:
+
+    from elasticfun.django.signals import updates
+
+    updates.register(User, lambda user: {'name': user.name})
+
+Their save and delete events are collected while `updates.collect()` is
+running, which `IndexUpdatesMiddleware` does around each request. Events
+of the same document are merged, and the whole batch is sent in a single
+bulk request once the transactions holding the changes are committed.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from . import Indexer
+
+logger = logging.getLogger(__name__)
+
+
+def _add(batch, index, key, action):
+    # The last event of a document wins, e.g. a save followed by a delete
+    # only deletes it
+    actions = batch.setdefault(index, OrderedDict())
+    actions.pop(key, None)
+    actions[key] = action
+
+
+class IndexUpdates(object):
+    """Collects the events of the registered models and sends them to
+    the cluster with an `Indexer`, or passes them to `queue`, a function
+    receiving a list of actions and the index name, that may hand them
+    to a background worker. The worker sends them with its own `Indexer`,
+    since `indexer` is only created when there's no `queue`."""
+
+    def __init__(self, indexer=None, queue=None):
+        self.indexer = indexer
+        self.queue = queue
+        self._models = {}
+        self._local = threading.local()
+
+    def register(self, model, serialize, index='default', doc_type=None):
+        """`serialize` receives an instance of the model and returns the
+        `_source` of its document. `doc_type` defaults to the name of the
+        model in lowercase."""
+        doc_type = doc_type or model.__name__.lower()
+        self._models[model] = (serialize, index, doc_type)
+        post_save.connect(self._saved, sender=model, weak=False,
+                          dispatch_uid=self._dispatch_uid(model))
+        post_delete.connect(self._deleted, sender=model, weak=False,
+                            dispatch_uid=self._dispatch_uid(model))
+
+    def unregister(self, model):
+        self._models.pop(model, None)
+        post_save.disconnect(sender=model, dispatch_uid=self._dispatch_uid(model))
+        post_delete.disconnect(sender=model, dispatch_uid=self._dispatch_uid(model))
+
+    @contextmanager
+    def collect(self, using=None):
+        """Holds the events until the block is over and sends them in a
+        single batch. If the block runs inside of a transaction, the
+        batch is only sent after it's committed. Nested blocks join the
+        outermost one."""
+        if getattr(self._local, 'batch', None) is not None:
+            yield
+            return
+
+        batch = self._local.batch = {}
+        try:
+            yield
+        finally:
+            self._local.batch = None
+            self._after_commit(using, partial(self.bulk, batch))
+
+    def bulk(self, batch):
+        """Sends a batch, a dict of the actions of each index keyed by
+        document"""
+        for index, actions in batch.items():
+            actions = list(actions.values())
+            if not actions:
+                continue
+            if self.queue is not None:
+                self.queue(actions, index)
+                continue
+
+            # The changes are already committed at this point, so failing
+            # to update the index shouldn't break the request
+            self.indexer = self.indexer or Indexer(workers=1)
+            try:
+                success, errors = self.indexer.bulk(actions, index=index)
+            except Exception:
+                logger.exception('Failed to update the index `%s`', index)
+                continue
+            for error in errors:
+                logger.error('Failed to update the index `%s`: %r', index, error)
+
+    def _saved(self, sender, instance, using=None, **kwargs):
+        serialize, index, doc_type = self._models[sender]
+        self._record(using, index, doc_type, instance.pk, {
+            '_op_type': 'index',
+            '_type': doc_type,
+            '_id': instance.pk,
+            '_source': serialize(instance),
+        })
+
+    def _deleted(self, sender, instance, using=None, **kwargs):
+        serialize, index, doc_type = self._models[sender]
+        self._record(using, index, doc_type, instance.pk, {
+            '_op_type': 'delete',
+            '_type': doc_type,
+            '_id': instance.pk,
+        })
+
+    def _record(self, using, index, doc_type, pk, action):
+        # Same keys as `Wrapper.get_key()`
+        key = '{}:{}'.format(doc_type, pk)
+
+        # Events are only collected once their transaction is committed,
+        # so rolled back changes never reach the index
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            batch = {index: {key: action}}
+            self._after_commit(using, partial(self.bulk, batch))
+        else:
+            self._after_commit(using, partial(_add, batch, index, key, action))
+
+    def _after_commit(self, using, function):
+        if transaction.get_connection(using).in_atomic_block:
+            transaction.on_commit(function, using=using)
+        else:
+            function()
+
+    def _dispatch_uid(self, model):
+        return 'elasticfun.{}.{}.{}'.format(
+            id(self), model._meta.app_label, model.__name__)
+
+
+updates = IndexUpdates()
+
+
+class IndexUpdatesMiddleware(object):
+    """Collects the index updates of each request with `updates.collect()`"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with updates.collect():
+            return self.get_response(request)
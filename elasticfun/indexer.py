@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+import json
+import threading
+import time
+
+import pyelasticsearch
+from six.moves import queue
+
+from .connections import default_registry, send_encoded
+from .exceptions import ImproperlyConfigured, ConfigMissingException
+from .queryset import _to_json
+
+# Keys of an action that go to the header line of the bulk request
+META_KEYS = (
+    '_index', '_type', '_id', '_routing', '_parent', '_version',
+    '_version_type', '_retry_on_conflict',
+)
+
+# Responses meaning the cluster is too busy right now, either for the
+# whole request or for some of its items. Those are sent again later.
+RETRY_STATUSES = (429, 503)
+
+
+class _Report(object):
+    # What the senders found out, shared by all of them
+
+    def __init__(self):
+        self.success = 0
+        self.errors = []
+        self.failure = None
+        self.lock = threading.Lock()
+
+
+class Indexer(object):
+    """Sends documents to the cluster through `_bulk` requests
+
+    The actions given to `bulk()` are dicts, usually the document itself
+    with a few metadata keys, like `_type` and `_id`. `_op_type` may be
+    `index` (the default), `create`, `update` or `delete`, and when the
+    action has a `_source` key, it's sent instead of the remaining keys.
+
+    Actions are grouped in requests of at most `max_docs` documents and
+    `max_bytes` bytes, sent by `workers` threads. When the senders fall
+    behind, at most two requests per worker wait in line and reading the
+    actions blocks until they catch up. Requests or items rejected by a
+    busy cluster are sent again up to `max_retries` times, waiting
+    `backoff` seconds before the first retry and doubling it each time.
+    """
+
+    def __init__(self, conf=None, registry=None, max_docs=500,
+                 max_bytes=5 * 1024 * 1024, workers=2, max_retries=3,
+                 backoff=0.5, max_backoff=30):
+        if not conf:
+            raise ConfigMissingException(
+                'You cannot initialize an indexer without a configuration object.')
+
+        self.conf = conf
+        self.registry = registry or default_registry()
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def raise_improperly_configured(self, index=None):
+        raise ImproperlyConfigured((
+            "There's no index called `{}`, the available ones are: {}."
+        ).format(index, ', '.join(self.conf.indexes)))
+
+    def bulk(self, actions, index='default'):
+        """
+        Indexes all the `actions`, which may be a generator, into `index`.
+        Returns the number of successful actions and a list with the
+        items of the bulk responses that failed.
+        """
+        if index not in self.conf.indexes:
+            self.raise_improperly_configured(index=index)
+        esinst = self.registry.get(self.conf.connections[index]['URL'])
+
+        report = _Report()
+        batches = queue.Queue(maxsize=self.workers * 2)
+        threads = [
+            threading.Thread(target=self._sender, args=(esinst, batches, report))
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for batch in self._batches(actions, index):
+                if report.failure is not None:
+                    break
+                batches.put(batch)
+        finally:
+            for _ in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+
+        if report.failure is not None:
+            raise report.failure
+        return report.success, report.errors
+
+    def _batches(self, actions, index):
+        batch, size = [], 0
+        for action in actions:
+            payload = self._serialize(action, index)
+            if batch and (len(batch) >= self.max_docs or
+                          size + len(payload) > self.max_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append((action, payload))
+            size += len(payload)
+        if batch:
+            yield batch
+
+    def _serialize(self, action, index):
+        source = dict(action)
+        op_type = source.pop('_op_type', 'index')
+        header = {'_index': index}
+        for key in META_KEYS:
+            if key in source:
+                header[key] = source.pop(key)
+        source = source.pop('_source', source)
+
+        lines = [json.dumps({op_type: header})]
+        if op_type != 'delete':
+            lines.append(json.dumps(source, default=_to_json))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def _sender(self, esinst, batches, report):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+
+            # After a failure we keep draining the queue, so the thread
+            # reading the actions never blocks waiting for us
+            if report.failure is not None:
+                continue
+            try:
+                self._send(esinst, batch, report)
+            except Exception as exc:
+                with report.lock:
+                    report.failure = report.failure or exc
+
+    def _send(self, esinst, batch, report):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+            body = b''.join(payload for _, payload in batch)
+            try:
+                response = send_encoded(esinst, 'POST', ['_bulk'], body)
+            except (pyelasticsearch.ConnectionError, pyelasticsearch.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except pyelasticsearch.ElasticHttpError as exc:
+                if exc.status_code not in RETRY_STATUSES or \
+                        attempt == self.max_retries:
+                    raise
+                continue
+
+            batch = self._collect_items(batch, response, attempt, report)
+            if not batch:
+                return
+
+    def _collect_items(self, batch, response, attempt, report):
+        # Returns the part of the batch that should be sent again
+        retry, success, errors = [], 0, []
+        for entry, item in zip(batch, response['items']):
+            result = list(item.values())[0]
+            status = result.get('status', 200)
+            if status in RETRY_STATUSES and attempt < self.max_retries:
+                retry.append(entry)
+            elif 'error' in result or status >= 300:
+                errors.append(item)
+            else:
+                success += 1
+
+        with report.lock:
+            report.success += success
+            report.errors.extend(errors)
+        return retry
@@ -3,10 +3,13 @@ from __future__ import unicode_literals, absolute_import
 
 import operator
 import re
-from six import text_type
+from collections import OrderedDict
+from six import string_types, text_type
+from six.moves import intern
 from datetime import datetime
 from functools import reduce
 
+from .cache import LRUCache
 from .compat import UnicodeMixin
 from .exceptions import ParsingException
 
@@ -14,10 +17,75 @@ LOOKUPS = ['lte', 'gte', 'lt', 'gt', 'in', 'range', 'startswith', 'endswith']
 
 LOOKUP_OPS = {'in': 'OR', 'range': 'TO'}
 
+# Characters reserved by the lucene and elasticsearch query syntax
+ESCAPE_CHARS = '+-&|!(){}[]^"~*?:\\/<>='
+
+# The backslash comes first, so we don't escape the ones we add
+ESCAPES = [(c, '\\' + c) for c in '\\' + ESCAPE_CHARS.replace('\\', '')]
+
+_UNSET = object()
+
+
+def _dsl_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_dsl_value(item) for item in value]
+    return value
+
+
+def _unique(values):
+    seen, unique = set(), []
+    for value in values:
+        try:
+            key = _freeze(value)
+        except TypeError:
+            unique.append(value)
+            continue
+        if key not in seen:
+            seen.add(key)
+            unique.append(value)
+    return unique
+
+
+def _freeze(value):
+    # Turning the value of a query into something hashable. Scalars are
+    # keyed by their type and text, which is what gets compiled: values
+    # like `True` and `1`, or `Decimal('1.0')` and `Decimal('1.00')`,
+    # are equal but don't compile to the same string
+    if isinstance(value, Query):
+        key = value.key
+        if key is None:
+            raise TypeError('unhashable query')
+        return key
+    kind = type(value).__name__
+    if isinstance(value, (list, tuple)):
+        return kind, tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return kind, frozenset(_freeze(item) for item in value)
+    hash(value)
+    return kind, text_type(value)
+
 
 class Query(UnicodeMixin):
 
-    re_spaces = re.compile(r'\s+')
+    # Queries are created by the hundreds of thousands when building big
+    # filters, so they don't carry a `__dict__`
+    __slots__ = (
+        'boost', '_empty', 'op', 'children', '_key', 'field', 'lookup', 'query')
+
+    re_tokens = re.compile(r"""
+        (?P<sign>[+-])?
+        (?:(?P<field>\w+):)?
+        (?:"(?P<phrase>[^"]*)"?|(?P<word>\S+))
+    """, re.VERBOSE | re.UNICODE)
+    re_escape = re.compile('[{}]'.format(re.escape(ESCAPE_CHARS)))
+
+    # Maps the structural key of a query to its compiled string, so
+    # queries built over and over again don't get evaluated every time.
+    # It's shared by the whole process, so it's also bounded by the total
+    # length of the strings it holds. Set it to `None` to disable it.
+    compiled = LRUCache(maxsize=4096, maxweight=4 * 1024 * 1024)
 
     def __init__(self, query=None, **kwargs):
 
@@ -28,7 +96,13 @@ class Query(UnicodeMixin):
         # not supposed to change them manually. Please refer to the
         # `Query.empty()` constructor.
         self._empty = kwargs.pop('_empty', False)
-        self._cache = None
+
+        # Queries combined with `&`, `|` and `~` become nodes holding the
+        # operator and the combined queries. Nodes are immutable, each
+        # combination creates a new one instead of changing its operands
+        self.op = kwargs.pop('_op', None)
+        self.children = kwargs.pop('_children', ())
+        self._key = _UNSET
 
         # After cleaning up the kwargs we'll have just the plain field
         # declaration
@@ -67,35 +141,253 @@ class Query(UnicodeMixin):
         return cls(_empty=True)
 
     @classmethod
-    def from_user_input(cls, user_input='', default_op='AND'):
-        user_input = user_input.strip()
-        user_input = [cls(token) for token in cls.re_spaces.split(user_input)]
-        op = operator.and_ if default_op == 'AND' else operator.or_
-        query = reduce(op, user_input)
-        return query
+    def from_user_input(cls, user_input='', default_op='AND', fields=()):
+        """Parses what a user typed in a search box. It understands
+        `"phrases"`, `+required` and `-excluded` terms, `OR` between two
+        terms and `field:value` for the fields listed in `fields`. The
+        other terms are combined with `default_op`.
+        """
+        required, excluded, optional = [], [], []
+        pending_or = False
+
+        for token in cls.re_tokens.finditer(user_input):
+            sign, field, phrase, word = token.group('sign', 'field', 'phrase', 'word')
+            if word in ('OR', 'AND') and not (sign or field):
+                pending_or = word == 'OR' and bool(optional)
+                continue
+
+            value = word if phrase is None else phrase
+            if not value:
+                continue
+            if field is None:
+                clause = cls(value)
+            elif field in fields:
+                clause = cls(**{field: value})
+            else:
+                clause = cls(token.group(0)[len(sign or ''):])
+
+            if sign == '-':
+                excluded.append(~clause)
+            elif sign == '+':
+                required.append(clause)
+            elif pending_or:
+                optional[-1].append(clause)
+            else:
+                optional.append([clause])
+            pending_or = False
+
+        # Terms joined by `OR` are grouped first and then the groups are
+        # combined with the default operator
+        if default_op == 'AND':
+            clauses = [cls._group('OR', group) for group in optional]
+        else:
+            clauses = optional and [
+                cls._group('OR', [c for group in optional for c in group])]
+        clauses = required + clauses + excluded
+
+        # A query made only of exclusions wouldn't match anything
+        if len(excluded) == len(clauses):
+            clauses.insert(0, cls())
+        return cls._group('AND', clauses)
+
+    @classmethod
+    def _group(cls, op, clauses):
+        if len(clauses) == 1:
+            return clauses[0]
+        return cls(_op=op, _children=tuple(clauses))
+
+    @property
+    def key(self):
+        """A hashable representation of the structure of this query. Two
+        queries with the same key compile to the same string. It's `None`
+        when the query holds values that can't be hashed"""
+        if self.op is not None:
+            return self._node_key()
+        if self._key is _UNSET:
+            self._key = self._leaf_key()
+        return self._key
 
     def __unicode__(self):
-        return self._cache or self._eval()
+        if self.op is None:
+            return self._compile(self.key, self._eval)
+        return self._compile(self.key, self._serialize)
 
     def __and__(self, other):
-        if self._empty:
-            self._cache = text_type(other)
-        else:
-            self._cache = '({} AND {})'.format(self, other)
-        self._empty = False
-        return self
+        return self._combine('AND', other)
 
     def __or__(self, other):
-        if self._empty:
-            self._cache = text_type(other)
-        else:
-            self._cache = '({} OR {})'.format(self, other)
-        self._empty = False
-        return self
+        return self._combine('OR', other)
 
     def __invert__(self):
-        self._cache = '(NOT {})'.format(self)
-        return self
+        return Query(_op='NOT', _children=(self,))
+
+    def _combine(self, op, other):
+        if self._empty:
+            return other
+        return Query(_op=op, _children=(self, other))
+
+    def optimize(self):
+        """Returns an equivalent query where the equality and `__in`
+        queries on the same field of an OR group are merged into a single
+        `__in` query, e.g.: `(cat:"a" OR cat:"b")` becomes
+        `cat:("a" OR "b")`. `to_dsl()` always does it, which turns them
+        into a single `terms` clause."""
+        if self.op is None:
+            return self
+        if self.op == 'NOT':
+            return ~self.children[0].optimize()
+
+        operands = [operand.optimize() for operand in self._operands()]
+        if self.op == 'OR':
+            operands = self._merge_terms(operands)
+        return reduce(
+            self.op == 'AND' and operator.and_ or operator.or_, operands)
+
+    @staticmethod
+    def _merge_terms(operands):
+        groups = OrderedDict()
+        merged = []
+        for operand in operands:
+            values = operand._terms()
+            if values is None:
+                merged.append(operand)
+                continue
+            if operand.field not in groups:
+                groups[operand.field] = []
+                merged.append(operand.field)
+            groups[operand.field].append((operand, values))
+
+        for position, item in enumerate(merged):
+            if not isinstance(item, string_types):
+                continue
+            group = groups[item]
+            if len(group) == 1:
+                merged[position] = group[0][0]
+            else:
+                values = _unique(v for _, values in group for v in values)
+                merged[position] = Query(**{'{}__in'.format(item): values})
+        return merged
+
+    def _terms(self):
+        # The values this query matches exactly on its field, or `None`
+        # when it can't be merged with other ones
+        if self.op is not None or self._empty or self.boost or not self.field:
+            return None
+        if self.lookup == 'in' and isinstance(self.query, (list, set)):
+            return list(self.query)
+        if self.lookup is None and \
+                not isinstance(self.query, (list, tuple, set, Query)):
+            return [self.query]
+        return None
+
+    def to_dsl(self):
+        """Compiles the query to the elasticsearch query DSL, using `term`,
+        `terms`, `range`, `prefix`, `wildcard` and `bool` clauses. Field
+        values are matched exactly, as they would be in a filter, so this
+        is meant for not analyzed fields. Words and boosts can't be
+        expressed with those clauses, so they become `query_string` ones.
+        """
+        if self.op == 'NOT':
+            return {'bool': {'must_not': [self.children[0].to_dsl()]}}
+        if self.op is not None:
+            operands = self._operands()
+            if self.op == 'OR':
+                operands = self._merge_terms(operands)
+            clauses = [operand.to_dsl() for operand in operands]
+            if len(clauses) == 1:
+                return clauses[0]
+            if self.op == 'AND':
+                return {'bool': {'must': clauses}}
+            return {'bool': {'should': clauses, 'minimum_should_match': 1}}
+
+        if self._empty or (self.field is None and self.query is None):
+            return {'match_all': {}}
+        if self.field is None or self.boost or isinstance(self.query, Query):
+            return {'query_string': {'query': text_type(self)}}
+
+        field, lookup, value = self.field, self.lookup, _dsl_value(self.query)
+        if lookup in ('lte', 'gte', 'lt', 'gt'):
+            return {'range': {field: {lookup: value}}}
+        if lookup == 'range':
+            return {'range': {field: {'gte': value[0], 'lte': value[1]}}}
+        if lookup == 'startswith':
+            return {'prefix': {field: value}}
+        if lookup == 'endswith':
+            return {'wildcard': {field: '*{}'.format(value)}}
+        if lookup == 'in' or isinstance(value, list):
+            return {'terms': {field: value if isinstance(value, list) else [value]}}
+        return {'term': {field: value}}
+
+    def _leaf_key(self):
+        if self._empty:
+            return ('EMPTY',)
+        try:
+            return (
+                'LEAF', self.field, self.lookup,
+                _freeze(self.query), _freeze(self.boost))
+        except TypeError:
+            return None
+
+    def _node_key(self):
+        # Queries memoize their keys, which is safe since they never change.
+        # We walk the tree with a stack instead of recursion cause long
+        # chains of `&` would blow the recursion limit
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node.op is None or node._key is not _UNSET:
+                continue
+            if visited:
+                keys = tuple(child.key for child in node.children)
+                node._key = None if None in keys else (node.op,) + keys
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children)
+        return self._key
+
+    def _operands(self):
+        # Chains of the same associative operator are written as a single
+        # group, `(a AND b AND c)` instead of `((a AND b) AND c)`
+        operands, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            if node.op == self.op:
+                stack.extend(reversed(node.children))
+            else:
+                operands.append(node)
+        return operands
+
+    def _serialize(self):
+        # Writing the whole tree in a single pass, every piece of the
+        # output is appended once and joined at the very end
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if not isinstance(item, Query):
+                parts.append(item)
+            elif item.op is None:
+                parts.append(text_type(item))
+            elif item.op == 'NOT':
+                stack.extend([')', item.children[0], '(NOT '])
+            else:
+                separator = ' {} '.format(item.op)
+                operands = item._operands()
+                stack.append(')')
+                for operand in reversed(operands[1:]):
+                    stack.extend([operand, separator])
+                stack.extend([operands[0], '('])
+        return ''.join(parts)
+
+    @classmethod
+    def _compile(cls, key, fmt):
+        if cls.compiled is None or key is None:
+            return fmt()
+        compiled = cls.compiled.get(key)
+        if compiled is None:
+            compiled = fmt()
+            cls.compiled.set(key, compiled)
+        return compiled
 
     def _process_field(self, field):
         field, val = list(field.items())[0]
@@ -108,15 +400,21 @@ class Query(UnicodeMixin):
                     "The valid lookups are: {}"
                 ).format(', '.join(LOOKUPS))
                 raise ParsingException(msg)
-        return field, lookup, val
+            lookup = intern(str(lookup))
+        # The same few field names are repeated over all the queries
+        return intern(str(field)), lookup, val
 
     def _escape(self, s):
-        r = []
-        for c in text_type(s):
-            if c in '+-&|!(){}[]^"~*?:\\':
-                r.append('\\')
-            r.append(c)
-        return ''.join(r)
+        # Most values have nothing to escape, and the ones that do are
+        # handled by `replace()` which is a lot faster than walking the
+        # string in python
+        s = text_type(s)
+        if self.re_escape.search(s) is None:
+            return s
+        for char, escaped in ESCAPES:
+            if char in s:
+                s = s.replace(char, escaped)
+        return s
 
     def _cast(self, val, lookup=None):
         if isinstance(val, bool):
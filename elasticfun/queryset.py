@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 
-from collections import defaultdict
+import json
+import threading
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+
 import pyelasticsearch
+from six import string_types, text_type
 
+from .aggregations import Aggregations, aggregation_body
+from .connections import default_registry, send_encoded
 from .exceptions import (
     ImproperlyConfigured,
     ConfigMissingException,
@@ -11,49 +18,333 @@ from .exceptions import (
 )
 from .query import Query
 
+# Parameters that `_msearch` expects in the header line of each search,
+# everything else goes to the request body
+HEADER_PARAMS = ('search_type', 'preference', 'routing')
+
+# The state of the lazy querysets, copied by `QuerySet._clone()`
+LAZY_ATTRS = ('_lazy', '_index', '_query', '_filter', '_order', '_window')
+
+# The `_source` filtering query string parameters and the keys they get
+# in a request body
+SOURCE_PARAMS = {'_source_include': 'include', '_source_exclude': 'exclude'}
+
+
+def _to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _sort_body(sort):
+    # Translating the `field:order,field` syntax of the query string to
+    # the list format expected in a request body
+    if not isinstance(sort, string_types):
+        return sort
+    return [
+        dict([item.split(':', 1)]) if ':' in item else item
+        for item in sort.split(',')
+    ]
+
+
+def _hydrate(wrapper, hits):
+    # Wrappers might return lazy objects, like django querysets, so we
+    # consume them here to make sure the work happens in the executor
+    return list(wrapper.wrap(hits))
+
+
+def _doc_types(wrapper):
+    doc_types = getattr(wrapper, 'doc_types', None)
+    if isinstance(doc_types, (list, tuple, set, frozenset)):
+        return doc_types
+    return None
+
+
+def _source_fields(wrappers):
+    # The fields all the wrappers need, or None when there are no
+    # wrappers or one of them needs the whole document
+    fields = []
+    for wrapper in wrappers or [None]:
+        needed = getattr(wrapper, 'source_fields', None)
+        if not isinstance(needed, (list, tuple, set, frozenset)):
+            return None
+        fields.extend(field for field in needed if field not in fields)
+    return fields
+
+
+def search_query(query, filter=None, aggs=None):
+    """Turns the query, filter and aggregations received by
+    `QuerySet.search()` into what the client expects, a string for the
+    `q` parameter or a dict with the request body"""
+    if filter is None and not aggs:
+        return isinstance(query, Query) and str(query) or query
+
+    if isinstance(query, dict):
+        body = dict(query)
+        must = body.get('query', {'match_all': {}})
+    else:
+        body = {}
+        query = query is not None and text_type(query) or ''
+        must = query and {'query_string': {'query': query}} \
+            or {'match_all': {}}
+
+    # The filter goes to the filter context of a bool query, so the
+    # cluster can cache it and doesn't need to score it
+    if filter is not None:
+        if isinstance(filter, Query):
+            filter = filter.to_dsl()
+        must = {'bool': {'must': must, 'filter': filter}}
+    body['query'] = must
+
+    if aggs:
+        body['aggs'] = dict(body.get('aggs', {}), **aggs)
+    return body
+
+
+def search_key(query, kwargs):
+    """The cache key of a search, made of the compiled query and the
+    search parameters. Dicts are dumped with sorted keys so the same
+    search always gets the same key"""
+    if not isinstance(query, string_types):
+        query = json.dumps(query, sort_keys=True, default=_to_json)
+    return query, json.dumps(kwargs, sort_keys=True, default=_to_json)
+
+
+def build_search_body(query, index, kwargs):
+    """Turns the arguments of `QuerySet.search()` into the header and
+    the body of a search request"""
+    header, body = {'index': index}, {}
+    kwargs = dict(kwargs)
+    query = search_query(
+        query, kwargs.pop('filter', None), kwargs.pop('aggs', None))
+    if isinstance(query, string_types):
+        body['query'] = {'query_string': {'query': query}}
+    else:
+        body.update(query)
+
+    for key, value in kwargs.items():
+        key = key[3:] if key.startswith('es_') else key
+        if key in HEADER_PARAMS:
+            header[key] = value
+        elif key == 'sort':
+            body[key] = _sort_body(value)
+        elif key in SOURCE_PARAMS:
+            if isinstance(value, string_types):
+                value = value.split(',')
+            source = body.get('_source')
+            if not isinstance(source, dict):
+                source = body['_source'] = {}
+            source[SOURCE_PARAMS[key]] = list(value)
+        else:
+            body[key] = value
+    return header, body
+
 
 class QuerySet(object):
 
-    def __init__(self, conf=None):
+    def __init__(self, conf=None, registry=None, executor=None, cache=None,
+                 singleflight=None):
         if not conf:
             raise ConfigMissingException(
                     'You cannot initialize a queryset without a configuration object.'
                     )
 
         self.conf = conf
+        self.registry = registry or default_registry()
         self.raw_results = None
         self.wrappers = []
 
+        # `_source` filtering, see `only()` and `defer()`
+        self.only_fields = None
+        self.defer_fields = ()
+
+        # The bodies of the aggregations by name, see `aggregate()`
+        self.aggs = OrderedDict()
+        self._aggregations = None
+
+        # The search built by `query()`, `filter()`, `exclude()`,
+        # `order_by()` and slicing, which only runs once the results are
+        # needed. See `_lazy_search()`
+        self._lazy = False
+        self._index = 'default'
+        self._query = None
+        self._filter = None
+        self._order = ()
+        self._window = (0, None)
+        self._result_cache = None
+
+        # When an executor (e.g. a `ThreadPoolExecutor`) is given, the
+        # wrappers of the different types hydrate their hits concurrently
+        self.executor = executor
+
+        # An optional `SearchCache`, shared by the querysets it's given to
+        self.cache = cache
+
+        # With a `SingleFlight`, identical searches running at the same
+        # time share a single request to the cluster
+        self.singleflight = singleflight
+
     def raise_improperly_configured(self, index=None):
         raise ImproperlyConfigured((
             "There's no index called `{}`, the available ones are: {}."
         ).format(index, ', '.join(self.conf.indexes)))
 
-    def search(self, query, index='default', **kwargs):
+    def get_client(self, index):
+        # Clients are reused across searches, so we don't open a new
+        # HTTP connection every time we talk to the same cluster
+        return self.registry.get(self.conf.connections[index]['URL'])
+
+    def search(self, query, index='default', filter=None, count_only=False,
+               **kwargs):
         """
         kwargs supported are the parameters listed at:
             http://www.elasticsearch.org/guide/reference/api/search/request-body/
         Namely: timeout, from, size and search_type.
         IMPORTANT: prepend ALL keys with "es_" as pyelasticsearch requires this
+
+        `filter` is a Query (or a DSL dict) sent in the filter context of
+        the search, compiled with `Query.to_dsl()`. It restricts the
+        results without affecting their scores.
+
+        With `count_only=True` no hits are fetched, only the total that
+        `count()` returns and the aggregations.
         """
         # Looking up the index
         if index not in self.conf.indexes:
             self.raise_improperly_configured(index=index)
 
         # Calling the backend search method
-        esurl = self.conf.connections[index]['URL']
-        esinst = pyelasticsearch.ElasticSearch(esurl)
+        esinst = self.get_client(index)
 
-        query = isinstance(query, Query) and str(query) or query
-        self.raw_results = esinst.search(query, index=index, **kwargs)
+        query = search_query(query, filter, self.aggs)
+        if count_only:
+            kwargs['es_size'] = 0
+        kwargs = self._source_kwargs(kwargs)
+        if self.cache is None:
+            self.raw_results = self._backend_search(esinst, query, index, kwargs)
+        else:
+            self.raw_results = self._cached_search(esinst, query, index, kwargs)
+        self._result_cache = None
 
         return self
 
-    def count(self):
+    def _cached_search(self, esinst, query, index, kwargs):
+        key = self.cache.entry_key(index, search_key(query, kwargs))
+        raw_results, stale = self.cache.get(key)
+        if raw_results is None:
+            raw_results = self._backend_search(esinst, query, index, kwargs)
+            self.cache.set(key, raw_results)
+        elif stale and self.cache.claim(key):
+            args = (esinst, query, index, kwargs, key)
+            if self.executor is not None:
+                self.executor.submit(self._refresh, *args)
+            else:
+                thread = threading.Thread(target=self._refresh, args=args)
+                thread.daemon = True
+                thread.start()
+        return raw_results
+
+    def _refresh(self, esinst, query, index, kwargs, key):
+        try:
+            raw_results = self._backend_search(esinst, query, index, kwargs)
+            self.cache.set(key, raw_results)
+        finally:
+            self.cache.release(key)
+
+    def _backend_search(self, esinst, query, index, kwargs):
+        if self.singleflight is None:
+            return esinst.search(query, index=index, **kwargs)
+        key = (index,) + search_key(query, kwargs)
+        return self.singleflight.do(
+            key, esinst.search, query, index=index, **kwargs)
+
+    def msearch(self, searches):
+        """
+        Runs many searches in a single `_msearch` round trip per cluster.
+        `searches` is a list of `(query, index, kwargs)` tuples, with the
+        same arguments `search()` receives. Returns one queryset per
+        search, in the same order, all of them sharing the wrappers of
+        this queryset.
+        """
+        results = [None] * len(searches)
+        for url, positions in self._group_searches(searches).items():
+            esinst = self.registry.get(url)
+            response = send_encoded(
+                esinst, 'GET', ['_msearch'], self._msearch_body(searches, positions))
+            self._collect_responses(results, positions, response)
+        return results
+
+    def _group_searches(self, searches):
+        # Grouping the searches by connection, each cluster gets a single
+        # request no matter how many indexes it holds
+        groups = OrderedDict()
+        for position, (query, index, kwargs) in enumerate(searches):
+            if index not in self.conf.indexes:
+                self.raise_improperly_configured(index=index)
+            url = self.conf.connections[index]['URL']
+            groups.setdefault(url, []).append(position)
+        return groups
+
+    def _msearch_body(self, searches, positions):
+        lines = []
+        for position in positions:
+            query, index, kwargs = searches[position]
+            kwargs = self._source_kwargs(dict(kwargs or {}))
+            if self.aggs:
+                kwargs.setdefault('aggs', self.aggs)
+            for line in build_search_body(query, index, kwargs):
+                lines.append(json.dumps(line, default=_to_json))
+        return '\n'.join(lines) + '\n'
+
+    def _collect_responses(self, results, positions, response):
+        for position, raw_results in zip(positions, response['responses']):
+            if 'error' in raw_results:
+                raise pyelasticsearch.ElasticHttpError(
+                    raw_results.get('status', 500), raw_results['error'])
+            results[position] = self._clone(raw_results=raw_results)
+
+    def _clone(self, **attrs):
+        queryset = self.__class__(
+            conf=self.conf, registry=self.registry, executor=self.executor,
+            cache=self.cache, singleflight=self.singleflight)
+        queryset.wrappers = self.wrappers[:]
+        queryset.only_fields = self.only_fields
+        queryset.defer_fields = self.defer_fields
+        queryset.aggs = self.aggs.copy()
+        for name in LAZY_ATTRS:
+            setattr(queryset, name, getattr(self, name))
+        for name, value in attrs.items():
+            setattr(queryset, name, value)
+        return queryset
+
+    def count(self, *args, **kwargs):
+        """
+        Without arguments, returns the total of hits of the last search.
+        Lazy querysets that didn't run yet ask the `_count` endpoint.
+
+        Otherwise it receives the same `query`, `index` and `filter` that
+        `search()` does, and asks the `_count` endpoint how many documents
+        match the query, without fetching any of them.
+        """
+        if args or kwargs:
+            return self._count(*args, **kwargs)
+        if self._lazy and self.raw_results is None:
+            query, index, filter, _ = self._lazy_search()
+            return self._count(query, index=index, filter=filter)
         if not self.raw_results:
             return 0
         return self.raw_results['hits']['total']
 
+    def _count(self, query=None, index='default', filter=None, **kwargs):
+        if index not in self.conf.indexes:
+            self.raise_improperly_configured(index=index)
+
+        esinst = self.get_client(index)
+        query = search_query(query, filter)
+        if not query:
+            query = {'query': {'match_all': {}}}
+        return esinst.count(query, index=index, **kwargs)['count']
+
     def max_score(self):
         if not self.raw_results:
             return 0
@@ -63,34 +354,300 @@ class QuerySet(object):
         self.wrappers.append(wrapper)
         return self
 
+    def aggregate(self, name, terms=None, range=None, date_histogram=None,
+                  **options):
+        """
+        Adds an aggregation to the searches of this queryset. Its kind is
+        given as a field name or as the dict ES expects, plus any option
+        of the aggregation, e.g.:
+
+            queryset.aggregate('tags', terms='tags', size=20)
+            queryset.aggregate('months', date_histogram='created', interval='month')
+
+        The results are read through `aggregations`. Searching with
+        `es_size=0` gets the count and the aggregations without any hits.
+        """
+        self.aggs[name] = aggregation_body(
+            name, terms=terms, range=range, date_histogram=date_histogram,
+            **options)
+        return self
+
+    @property
+    def aggregations(self):
+        raw = (self.raw_results or {}).get('aggregations') or {}
+        if self._aggregations is None or self._aggregations.data is not raw:
+            kinds = dict((name, list(body)[0]) for name, body in self.aggs.items())
+            self._aggregations = Aggregations(raw, kinds)
+        return self._aggregations
+
+    def only(self, *fields):
+        """Fetches only the given fields of the `_source` of the hits"""
+        self.only_fields = fields
+        return self
+
+    def defer(self, *fields):
+        """Leaves the given fields out of the `_source` of the hits"""
+        self.defer_fields = self.defer_fields + fields
+        return self
+
+    def ids_only(self):
+        """Fetches the hits without their `_source`, which is all most
+        wrappers need to load the objects from a database"""
+        return self.only()
+
+    def _source_kwargs(self, kwargs):
+        # When `only()` wasn't called, we ask for the fields the wrappers
+        # declare through `source_fields`. The kwargs given to the search
+        # win over both
+        if kwargs.get('es_size') == 0:
+            return kwargs
+        only = self.only_fields
+        if only is None:
+            only = _source_fields(self.wrappers)
+
+        source = {}
+        if only is not None and not only:
+            source['es__source'] = False
+        else:
+            if only:
+                source['es__source_include'] = list(only)
+            if self.defer_fields:
+                source['es__source_exclude'] = list(self.defer_fields)
+        if not source:
+            return kwargs
+        source.update(kwargs)
+        return source
+
     def items(self, clean=True):
+        hits = self._hits()
+        if not self.wrappers:
+            return hits
+        return self._wrap_hits(hits, clean)
+
+    def iter_items(self, chunk_size=100, clean=True):
+        """
+        Same as `items()`, but the hits are wrapped `chunk_size` at a time
+        and each result is yielded, in the order of the hits, as soon as
+        its chunk is ready. Wrappers get smaller lists and the wrapped
+        objects of the whole page are never held at once.
+        """
+        hits = self._hits()
+        return self._iter_chunks(hits, chunk_size, clean)
+
+    def _iter_chunks(self, hits, chunk_size, clean):
+        for start in range(0, len(hits), chunk_size):
+            chunk = hits[start:start + chunk_size]
+            for item in (self._wrap_hits(chunk, clean) if self.wrappers else chunk):
+                yield item
+
+    def iter_all(self, query, index='default', batch_size=500, scroll='1m',
+                 clean=True, filter=None, **kwargs):
+        """
+        Iterates over every hit matching `query` using the scroll API.
+        Hits are fetched and wrapped `batch_size` at a time, so only a
+        single batch is kept in memory. kwargs are the same `search()`
+        receives.
+        """
+        if index not in self.conf.indexes:
+            self.raise_improperly_configured(index=index)
+
+        query = search_query(query, filter)
+        kwargs = self._source_kwargs(kwargs)
+        kwargs.update(es_scroll=scroll, es_size=batch_size)
+        return self._scroll(query, index, scroll, clean, kwargs)
+
+    def _scroll(self, query, index, scroll, clean, kwargs):
+        esinst = self.get_client(index)
+        raw_results = esinst.search(query, index=index, **kwargs)
+        scroll_id = raw_results.get('_scroll_id')
+        try:
+            while raw_results['hits']['hits']:
+                hits = raw_results['hits']['hits']
+                for item in self._iter_chunks(hits, len(hits), clean):
+                    yield item
+                raw_results = send_encoded(
+                    esinst, 'GET', ['_search', 'scroll'], scroll_id,
+                    {'scroll': scroll})
+                scroll_id = raw_results.get('_scroll_id', scroll_id)
+        finally:
+            # Letting the cluster free the search context right away,
+            # even if the caller didn't consume the whole generator
+            if scroll_id:
+                try:
+                    esinst.send_request('DELETE', ['_search', 'scroll', scroll_id])
+                except pyelasticsearch.ElasticHttpError:
+                    pass
+
+    def _wrap_hits(self, hits, clean):
+        _order_dict, _type_dict = self._group_hits(hits)
+        if self.executor is None:
+            wrapped = [
+                (wrapper, wrapper.wrap(typed_results))
+                for wrapper, typed_results in _type_dict.items()
+            ]
+        else:
+            futures = [
+                (wrapper, self.executor.submit(_hydrate, wrapper, typed_results))
+                for wrapper, typed_results in _type_dict.items()
+            ]
+            wrapped = [(wrapper, future.result()) for wrapper, future in futures]
+        return self._merge_wrapped(hits, _order_dict, wrapped, clean)
+
+    def query(self, query):
+        """
+        The methods below build a search that only runs when its results
+        are first needed, e.g. by `items()`, `len()` or a loop, Django
+        style. Each of them returns a new queryset.
+
+        `query()` sets the query that scores the results.
+        """
+        return self._lazy_clone(_query=query)
+
+    def using(self, index):
+        return self._lazy_clone(_index=index)
+
+    def filter(self, *queries, **lookups):
+        """Keeps the results matching all the queries, which are `Query`
+        objects or lookups, e.g. `filter(Query(tags='food'), price__lt=10)`.
+        They're sent in the filter context, so they don't change the
+        scores."""
+        return self._lazy_clone(_filter=self._combine_filter(queries, lookups))
+
+    def exclude(self, *queries, **lookups):
+        """Leaves out the results matching all the queries, e.g.
+        `exclude(status='closed', private=True)` keeps the closed deals
+        that aren't private"""
+        return self._lazy_clone(
+            _filter=self._combine_filter(queries, lookups, negate=True))
+
+    def order_by(self, *fields):
+        """Sorts by the given fields, descending when prefixed by `-`"""
+        order = tuple(
+            field.startswith('-') and '{}:desc'.format(field[1:]) or field
+            for field in fields)
+        return self._lazy_clone(_order=order)
+
+    def __getitem__(self, key):
+        # Once the search ran, we just slice the results we already have
+        if self._result_cache is not None or self.raw_results is not None:
+            return self._results()[key]
+
+        start, stop = self._window
+        if isinstance(key, slice):
+            if (key.start or 0) < 0 or (key.stop or 0) < 0 or key.step:
+                raise ValueError('Only positive slices with no step are supported.')
+            new_start, new_stop = start + (key.start or 0), stop
+            if key.stop is not None:
+                new_stop = start + key.stop
+                if stop is not None:
+                    new_stop = min(stop, new_stop)
+            if new_stop is not None:
+                new_stop = max(new_start, new_stop)
+            return self._lazy_clone(_window=(new_start, new_stop))
+
+        if key < 0:
+            raise ValueError('Negative indexing is not supported.')
+        return self[key:key + 1]._results()[0]
+
+    def __iter__(self):
+        return iter(self._results())
+
+    def __len__(self):
+        return len(self._results())
+
+    def __bool__(self):
+        # Only lazy querysets stand for their results, the others are
+        # always true
+        if not self._lazy:
+            return True
+        return bool(self._results())
+    __nonzero__ = __bool__
+
+    def _results(self):
+        if self._result_cache is None:
+            self._result_cache = self.items()
+        return self._result_cache
+
+    def _lazy_clone(self, **attrs):
+        return self._clone(_lazy=True, **attrs)
+
+    def _combine_filter(self, queries, lookups, negate=False):
+        # `Query` takes a single field per call, so each lookup gets its own
+        queries = list(queries) + [
+            Query(**{field: value}) for field, value in sorted(lookups.items())]
+        if not queries:
+            return self._filter
+
+        query = queries[0]
+        for other in queries[1:]:
+            query = query & other
+        # Like Django, `exclude(a, b)` leaves out what matches both of them
+        if negate:
+            query = ~query
+        return query if self._filter is None else self._filter & query
+
+    def _lazy_search(self):
+        # The arguments for `search()` of a lazy queryset
+        kwargs = {}
+        if self._order:
+            kwargs['es_sort'] = ','.join(self._order)
+        start, stop = self._window
+        if start:
+            kwargs['es_from'] = start
+        if stop is not None:
+            kwargs['es_size'] = stop - start
+        return self._query, self._index, self._filter, kwargs
+
+    def _execute(self):
+        if self._lazy and self.raw_results is None:
+            query, index, filter, kwargs = self._lazy_search()
+            self.search(query, index=index, filter=filter, **kwargs)
+
+    def _hits(self):
+        self._execute()
         if self.raw_results is None:
             raise EmptyQuerySetException(
                 'This QuerySet object is empty. Make sure a search has '
                 'been made before calling the items() method.'
             )
+        return self.raw_results['hits']['hits'][:]
 
-        hits = self.raw_results['hits']['hits'][:]
-        if not self.wrappers:
-            return hits
-
+    def _group_hits(self, hits):
         _order_dict = {}
         _type_dict = defaultdict(list)
 
-        for wrapper in self.wrappers:
-            for hit_order, hit in enumerate(hits):
-                if wrapper.match(hit):
+        # Each hit is routed to the first wrapper that takes it. Wrappers
+        # declaring `doc_types` are picked straight from the `_type` of
+        # the hit, the other ones still need to be asked through `match()`
+        declared = [(wrapper, _doc_types(wrapper)) for wrapper in self.wrappers]
+        typed = any(doc_types is not None for _, doc_types in declared)
+
+        dispatch = {}
+        for hit_order, hit in enumerate(hits):
+            doc_type = hit.get('_type') if typed else None
+            candidates = dispatch.get(doc_type)
+            if candidates is None:
+                candidates = dispatch[doc_type] = [
+                    (wrapper, doc_types is not None)
+                    for wrapper, doc_types in declared
+                    if doc_types is None or doc_type in doc_types
+                ]
+
+            for wrapper, by_type in candidates:
+                if by_type or wrapper.match(hit):
                     _type_dict[wrapper].append(hit)
                     _order_dict[wrapper.get_key(hit)] = hit_order
+                    break
+        return _order_dict, _type_dict
 
+    def _merge_wrapped(self, hits, _order_dict, wrapped, clean):
         # Creating a list of None items of length == len(hits)
         # This will be useful for correctly placing the wrapped object
         # in the sorted order, as well as gives us an indication of
         # what objects did not get wrapped correctly due to database / ES
         # index inconsistencies
         processed_results = [None] * len(hits)
-        for wrapper, typed_results in _type_dict.items():
-            wrapped_hits = wrapper.wrap(typed_results)
+        for wrapper, wrapped_hits in wrapped:
             for hit in wrapped_hits:
                 index = _order_dict[wrapper.get_key(hit)]
                 processed_results[index] = hit
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Decoding of the responses sent by the cluster
+
+`loads()` uses the fastest JSON library installed, `orjson` when it's
+available. `lazy_loads()` goes further when `pysimdjson` is installed:
+the hits of the response become `Hit` views, that only turn the fields
+of a hit into python objects when they're accessed. Wrappers that only
+read `_type` and `_id` never pay for decoding the `_source`.
+
+`Hit` views aren't JSON serializable, so `json.dumps()` fails on a
+response decoded lazily. Turn the hits into dicts first, e.g.
+`[dict(hit) for hit in hits]`.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import json
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def lazy_loads(data):
+    if simdjson is None:
+        return loads(data)
+
+    # Each document needs its own parser, since a parser can't be reused
+    # while there are views pointing to its previous document
+    return _materialize(simdjson.Parser().parse(data))
+
+
+def _materialize(value):
+    # Everything but the hits is turned into regular dicts and lists, so
+    # the response works like the one pyelasticsearch gives us
+    if isinstance(value, simdjson.Object):
+        # `Object.items()` would decode the whole object at once
+        converted = {}
+        for key in value.keys():
+            item = value[key]
+            converted[key] = _hits(item) if key == 'hits' else _materialize(item)
+        return converted
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
+def _hits(value):
+    if not isinstance(value, simdjson.Array):
+        return _materialize(value)
+    return [
+        Hit(hit) if isinstance(hit, simdjson.Object) else _materialize(hit)
+        for hit in value
+    ]
+
+
+class Hit(Mapping):
+    """A read only view over a hit of a response decoded by simdjson
+
+    Each field is decoded on its first access and kept for the next ones.
+    Pickling a hit gives a regular dict, but `json.dumps()` can't encode
+    it, use `dict(hit)` for that.
+    """
+
+    __slots__ = ('_hit', '_values')
+
+    def __init__(self, hit):
+        self._hit = hit
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = _materialize(self._hit[key])
+            return value
+
+    def __contains__(self, key):
+        # `Mapping` would look the value up, decoding it
+        return key in self._hit
+
+    def __iter__(self):
+        return iter(self._hit.keys())
+
+    def __len__(self):
+        return len(self._hit)
+
+    def __repr__(self):
+        return 'Hit({!r})'.format(dict(self))
+
+    def __reduce__(self):
+        return dict, (dict(self),)
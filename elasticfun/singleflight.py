@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+import threading
+
+
+class _Call(object):
+    # The call in flight for a key, holding its outcome once it's done
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class SingleFlight(object):
+    """Runs a single call at a time per key
+
+    Threads calling `do()` with a key that's already in flight don't run
+    the function again, they wait for the running call and all get its
+    result (or exception). Querysets sharing one of these send identical
+    concurrent searches to the cluster only once.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            return call.wait()
+
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            self._forget(key)
+            call.done.set()
+        return call.result
+
+    def _forget(self, key):
+        # Calls made from now on run the function again, while the ones
+        # already waiting get the result we're about to set
+        with self._lock:
+            self._calls.pop(key, None)
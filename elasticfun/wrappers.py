@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
-from __future__ import unicode_literals
+from __future__ import unicode_literals, absolute_import
+
+from .cache import LRUCache
 
 
 class Wrapper(object):
 
+    # The `_type`s handled by this wrapper. When declared, the queryset
+    # routes the hits by their type without calling `match()`. Each hit
+    # is wrapped by the first registered wrapper that takes it.
+    doc_types = None
+
+    # The fields of the `_source` this wrapper reads. When all the wrappers
+    # of a queryset declare them, only those fields are fetched, and an
+    # empty tuple means the wrapper only needs `_type` and `_id`.
+    source_fields = None
+
     @classmethod
     def get_key(cls, obj):
         return '{}:{}'.format(obj['_type'], obj['_id'])
@@ -15,3 +27,65 @@ class Wrapper(object):
     @classmethod
     def wrap(cls, obj):
         raise NotImplementedError
+
+
+class CachedWrapper(object):
+    """Caches the objects built by another wrapper
+
+    The cache is looked up in bulk for all the hits of a search, and only
+    the misses are passed to the `wrap()` method of the original wrapper.
+    Keys are made of the `get_key()` of the hit and its version, which is
+    the `_version` of the hit by default (the search must be made with
+    `es_version=True` to get it). Pass a `version` function receiving a
+    hit to use something else, like a timestamp stored in the document.
+
+    The backend needs the `get_many()`, `set_many()` and `delete()`
+    methods, e.g. `elasticfun.cache.LRUCache` or
+    `elasticfun.django.cache.DjangoCache`. Wrappers whose `wrap()` is a
+    coroutine are cached by `elasticfun.aio.AsyncCachedWrapper` instead.
+    """
+
+    def __init__(self, wrapper, backend=None, version=None, prefix='elasticfun'):
+        self.wrapper = wrapper
+        self.backend = backend if backend is not None else LRUCache(ttl=300)
+        self.version = version or (lambda hit: hit.get('_version'))
+        self.prefix = prefix
+        self.doc_types = getattr(wrapper, 'doc_types', None)
+        self.source_fields = getattr(wrapper, 'source_fields', None)
+
+    def get_key(self, obj):
+        return self.wrapper.get_key(obj)
+
+    def match(self, obj):
+        return self.wrapper.match(obj)
+
+    def cache_key(self, hit):
+        return '{}:{}:{}'.format(self.prefix, self.get_key(hit), self.version(hit))
+
+    def invalidate(self, hit):
+        self.backend.delete(self.cache_key(hit))
+
+    def wrap(self, hits):
+        keys, cached, misses = self._lookup(hits)
+        fresh = misses and self.wrapper.wrap(misses) or []
+        if hasattr(fresh, '__await__'):
+            # Closing the coroutine, so it doesn't warn it was never awaited
+            getattr(fresh, 'close', lambda: None)()
+            raise TypeError(
+                'The wrap() method of {!r} is a coroutine, cache it with '
+                'elasticfun.aio.AsyncCachedWrapper instead.'.format(self.wrapper))
+        return self._store(keys, cached, fresh)
+
+    def _lookup(self, hits):
+        keys = dict((self.get_key(hit), self.cache_key(hit)) for hit in hits)
+        cached = self.backend.get_many(list(keys.values()))
+        misses = [hit for hit in hits if keys[self.get_key(hit)] not in cached]
+        return keys, cached, misses
+
+    def _store(self, keys, cached, fresh):
+        # The wrapped objects have the same `get_key()` of their hits,
+        # that's also how the queryset puts them back in order
+        fresh = list(fresh)
+        self.backend.set_many(dict(
+            (keys[self.get_key(obj)], obj) for obj in fresh))
+        return list(cached.values()) + fresh
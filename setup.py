@@ -74,6 +74,6 @@ if __name__ == '__main__':
             'Operating System :: POSIX',
             'Programming Language :: Python',
             'Programming Language :: Python :: 2.7',
-            'Programming Language :: Python :: 3.3',
+            'Programming Language :: Python :: 3.4',
         )
     )
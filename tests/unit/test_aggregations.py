@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from elasticfun.aggregations import (
+    Aggregations,
+    DateBucket,
+    RangeBucket,
+    aggregation_body,
+)
+
+
+def test_aggregation_body():
+    aggregation_body('tags', terms='tags', size=20).should.equal(
+        {'terms': {'field': 'tags', 'size': 20}})
+    aggregation_body('prices', range={'field': 'price', 'ranges': [{'to': 10}]}) \
+        .should.equal({'range': {'field': 'price', 'ranges': [{'to': 10}]}})
+    aggregation_body('months', date_histogram='created', interval='month') \
+        .should.equal({'date_histogram': {'field': 'created', 'interval': 'month'}})
+
+
+def test_aggregation_body_needs_a_single_kind():
+    aggregation_body.when.called_with('tags').should.throw(
+        ValueError,
+        'The aggregation `tags` needs exactly one of: terms, range, date_histogram')
+    aggregation_body.when.called_with('tags', terms='a', range='b') \
+        .should.throw(ValueError)
+
+
+def test_aggregations_are_parsed_on_access():
+    data = {
+        'tags': {'buckets': [
+            {'key': 'ice', 'doc_count': 10}, {'key': 'cream', 'doc_count': 3}]},
+        'prices': {'buckets': [
+            {'key': '*-10.0', 'to': 10.0, 'doc_count': 4},
+            {'key': '10.0-*', 'from': 10.0, 'doc_count': 9}]},
+        'months': {'buckets': [
+            {'key': 1388534400000, 'key_as_string': '2014-01-01', 'doc_count': 2}]},
+    }
+    kinds = {'tags': 'terms', 'prices': 'range', 'months': 'date_histogram'}
+
+    # When I read the aggregations of a response
+    aggregations = Aggregations(data, kinds)
+    set(aggregations).should.equal({'tags', 'prices', 'months'})
+    aggregations._parsed.should.equal({})
+
+    # Then I see that each of them is parsed into typed buckets
+    aggregations['tags'].counts().should.equal({'ice': 10, 'cream': 3})
+    list(aggregations._parsed).should.equal(['tags'])
+
+    start, end = aggregations['prices']
+    start.should.be.a(RangeBucket)
+    (start.start, start.end, start.count).should.equal((None, 10.0, 4))
+    (end.start, end.end, end.count).should.equal((10.0, None, 9))
+
+    month, = aggregations['months'].buckets
+    month.should.be.a(DateBucket)
+    month.key.should.equal(datetime(2014, 1, 1))
+    aggregations['months'].should.be(aggregations['months'])
@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from mock import Mock
+from pyelasticsearch import ElasticHttpError
+
+from elasticfun import CachedWrapper, Query, Wrapper
+from elasticfun.aio import (
+    AsyncCachedWrapper, AsyncClientRegistry, AsyncQuerySet, AsyncSingleFlight)
+from elasticfun.cache import LRUCache, SearchCache
+
+
+class StubServer(object):
+    """A tiny HTTP server that records the requests it receives and
+    answers all of them with the same JSON document. Given a list, it
+    answers with each of its documents in turn, the last one repeating."""
+
+    def __init__(self, response, status=200):
+        self.requests = []
+        stub = self
+        responses = response if isinstance(response, list) else [response]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                url = urlparse(self.path)
+                stub.requests.append({
+                    'method': self.command,
+                    'path': url.path,
+                    'params': parse_qs(url.query),
+                    'body': self.rfile.read(length).decode('utf-8'),
+                })
+                response = responses[min(len(stub.requests), len(responses)) - 1]
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_DELETE = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run(queryset, coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await queryset.registry.close()
+    return asyncio.run(main())
+
+
+def make_queryset(url):
+    connections = {'default': {'URL': url}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    return AsyncQuerySet(conf=conf)
+
+
+def test_async_search_with_query_objects():
+    response = {'hits': {'total': 2, 'max_score': 1.5, 'hits': ['hit1', 'hit2']}}
+    with StubServer(response) as server:
+        # Given that I have an async queryset
+        queryset = make_queryset(server.url)
+
+        # When I search for a query object
+        results = run(queryset, queryset.search(
+            Query('ice') & Query('cream'), es_size=10))
+
+        # Then I see that the query was sent in the query string, just
+        # like pyelasticsearch does
+        server.requests.should.equal([{
+            'method': 'GET',
+            'path': '/default/_search',
+            'params': {'q': ['("ice" AND "cream")'], 'size': ['10']},
+            'body': '',
+        }])
+
+    # And I see the results in the queryset
+    results.should.be(queryset)
+    run(queryset, results.count()).should.equal(2)
+    results.max_score().should.equal(1.5)
+    run(queryset, results.items()).should.equal(['hit1', 'hit2'])
+
+
+def test_async_search_with_dicts():
+    with StubServer({'hits': {'total': 0, 'hits': []}}) as server:
+        queryset = make_queryset(server.url)
+
+        # When I search using a dict
+        query = {'query': {'match_all': {}}}
+        run(queryset, queryset.search(query))
+
+        # Then I see that it was sent as the request body
+        json.loads(server.requests[0]['body']).should.equal(query)
+
+
+def test_async_search_errors():
+    with StubServer({'error': 'SearchPhaseExecutionException'}, status=400) as server:
+        queryset = make_queryset(server.url)
+
+        # When the cluster answers with an error, Then I see that it's raised
+        run.when.called_with(queryset, queryset.search('a')).should.throw(
+            ElasticHttpError)
+
+
+def test_async_items_with_coroutine_wrappers():
+    hit1 = {'_type': 'type1', '_id': 'some_id'}
+    hit2 = {'_type': 'type2', '_id': 'another_id'}
+    hit3 = {'_type': 'type1', '_id': 'last_id'}
+    response = {'hits': {'hits': [hit1, hit2, hit3]}}
+
+    # Given that I have a wrapper whose `wrap()` is a coroutine and
+    # another regular one
+    class AsyncWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return obj['_type'] == 'type1'
+
+        @classmethod
+        async def wrap(cls, objs):
+            await asyncio.sleep(0)
+            return [dict(obj, wrapped='async') for obj in objs]
+
+    class SyncWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return obj['_type'] == 'type2'
+
+        @classmethod
+        def wrap(cls, objs):
+            return [dict(obj, wrapped='sync') for obj in objs]
+
+    with StubServer(response) as server:
+        queryset = make_queryset(server.url)
+        queryset.wrap(AsyncWrapper).wrap(SyncWrapper)
+
+        async def search_and_wrap():
+            await queryset.search('stuff')
+            return await queryset.items()
+
+        # When I search and get the items
+        items = run(queryset, search_and_wrap())
+
+    # Then I see that both wrappers were applied, keeping the order
+    items.should.equal([
+        dict(hit1, wrapped='async'),
+        dict(hit2, wrapped='sync'),
+        dict(hit3, wrapped='async'),
+    ])
+
+
+def test_async_msearch():
+    response = {'responses': [{'hits': {'total': 1}}, {'hits': {'total': 2}}]}
+    with StubServer(response) as server:
+        queryset = make_queryset(server.url)
+
+        # When I run two searches at once
+        results = run(queryset, queryset.msearch([
+            ('a', 'default', {}),
+            ('b', 'default', {'es_size': 5}),
+        ]))
+
+        # Then I see that a single request was made
+        server.requests.should.have.length_of(1)
+        server.requests[0]['path'].should.equal('/_msearch')
+
+    [run(queryset, r.count()) for r in results].should.equal([1, 2])
+
+
+def test_async_registry_reuses_sessions():
+    registry = AsyncClientRegistry()
+
+    async def get_twice():
+        try:
+            return registry.get('http://localhost:9200'), \
+                registry.get('http://localhost:9200')
+        finally:
+            await registry.close()
+
+    # When I ask for the same URL twice inside the same loop
+    client1, client2 = asyncio.run(get_twice())
+
+    # Then I see that the same client was returned
+    client1.should.be(client2)
+    client1.session.closed.should.be.true
+
+
+def test_async_items_run_the_wrappers_concurrently():
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'deal', '_id': '2'}
+    response = {'hits': {'hits': [hit1, hit2]}}
+
+    # Given that I have two coroutine wrappers that wait for each other
+    # and a regular one, running in an executor
+    events = {}
+
+    class UserWrapper(Wrapper):
+        doc_types = ('user',)
+
+        @classmethod
+        async def wrap(cls, objs):
+            events['user'].set()
+            await asyncio.wait_for(events['deal'].wait(), 5)
+            return objs
+
+    class DealWrapper(Wrapper):
+        doc_types = ('deal',)
+
+        @classmethod
+        async def wrap(cls, objs):
+            events['deal'].set()
+            await asyncio.wait_for(events['user'].wait(), 5)
+            return objs
+
+    class OtherWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return True
+
+        @classmethod
+        def wrap(cls, objs):
+            events['thread'] = threading.current_thread()
+            return objs
+
+    with StubServer(response) as server, ThreadPoolExecutor(1) as executor:
+        queryset = make_queryset(server.url)
+        queryset.executor = executor
+        queryset.wrap(UserWrapper).wrap(DealWrapper).wrap(OtherWrapper)
+
+        async def search_and_wrap():
+            events['user'], events['deal'] = asyncio.Event(), asyncio.Event()
+            await queryset.search('stuff')
+            first = await queryset.items()
+            queryset.raw_results = {'hits': {'hits': [{'_type': 'x', '_id': '3'}]}}
+            return first, await queryset.items()
+
+        # When I get the items
+        first, second = run(queryset, search_and_wrap())
+
+    # Then I see that the coroutines ran concurrently and the regular
+    # wrapper ran in the executor
+    first.should.equal([hit1, hit2])
+    second.should.equal([{'_type': 'x', '_id': '3'}])
+    events['thread'].should_not.be(threading.current_thread())
+
+
+def test_async_search_with_a_cache():
+    response = {'hits': {'total': 1, 'hits': ['hit1']}}
+    with StubServer(response) as server:
+        # Given that I have an async queryset with a search cache
+        queryset = make_queryset(server.url)
+        queryset.cache = SearchCache(ttl=60)
+
+        # When I run the same search twice
+        async def search_twice():
+            await queryset.search(Query('ice'), es_size=10)
+            return await queryset.search(Query('ice'), es_size=10)
+        results = run(queryset, search_twice())
+
+        # Then I see that the cluster was called only once
+        server.requests.should.have.length_of(1)
+        run(queryset, results.items()).should.equal(['hit1'])
+
+
+def test_async_search_with_singleflight():
+    response = {'hits': {'total': 1, 'hits': ['hit1']}}
+    with StubServer(response) as server:
+        # Given that I have async querysets sharing a single flight
+        queryset = make_queryset(server.url)
+        queryset.singleflight = AsyncSingleFlight()
+
+        # When they run the same search concurrently
+        async def search_many():
+            return await asyncio.gather(*[
+                queryset._clone().search(Query('ice'), es_size=10)
+                for _ in range(5)
+            ])
+        results = run(queryset, search_many())
+
+        # Then I see that the cluster was called only once
+        server.requests.should.have.length_of(1)
+        [result.raw_results for result in results].should.equal([response] * 5)
+
+
+def test_async_search_with_lazy_responses():
+    response = {'hits': {'total': 1, 'hits': [
+        {'_type': 'user', '_id': '1', '_source': {'name': 'Lincoln'}}]}}
+    with StubServer(response) as server:
+        # Given that I have a queryset decoding responses lazily
+        queryset = make_queryset(server.url)
+        queryset.registry = AsyncClientRegistry(lazy=True)
+
+        # When I search, Then I see the same results
+        results = run(queryset, queryset.search('name:lincoln'))
+        results.raw_results.should.equal(response)
+
+
+def test_async_count():
+    with StubServer({'count': 3}) as server:
+        queryset = make_queryset(server.url)
+
+        # When I count the documents matching a query
+        count = run(queryset, queryset.count(Query('ice')))
+
+        # Then I see that the `_count` endpoint was used
+        count.should.equal(3)
+        server.requests.should.equal([{
+            'method': 'GET',
+            'path': '/default/_count',
+            'params': {'q': ['"ice"']},
+            'body': '',
+        }])
+
+
+def test_async_lazy_querysets():
+    response = {'hits': {'total': 1, 'hits': ['hit1']}}
+    with StubServer(response) as server:
+        queryset = make_queryset(server.url).query('ice').order_by('-date')[:10]
+
+        # When I go through a lazy queryset with `async for`
+        async def consume():
+            return [item async for item in queryset]
+
+        # Then I see that its search ran with the window I asked for
+        run(queryset, consume()).should.equal(['hit1'])
+        server.requests[0]['params'].should.equal({
+            'q': ['ice'], 'sort': ['date:desc'], 'size': ['10']})
+
+
+def test_async_lazy_querysets_read_like_lists_once_fetched():
+    response = {'hits': {'total': 2, 'hits': ['hit1', 'hit2']}}
+    with StubServer(response) as server:
+        queryset = make_queryset(server.url).query('ice')
+
+        # When I read the results of a lazy queryset before fetching it
+        # Then I see that I'm told to fetch it first
+        len.when.called_with(queryset).should.throw(
+            TypeError, 'await queryset.fetch()')
+        bool.when.called_with(queryset).should.throw(
+            TypeError, 'await queryset.fetch()')
+        queryset.__getitem__.when.called_with(0).should.throw(
+            TypeError, 'await queryset.fetch()')
+
+        # When I fetch it
+        run(queryset, queryset.fetch())
+
+    # Then I see that it reads like the list of its results
+    len(queryset).should.equal(2)
+    bool(queryset).should.be.true
+    queryset[0].should.equal('hit1')
+    queryset[1:].should.equal(['hit2'])
+    list(queryset).should.equal(['hit1', 'hit2'])
+    server.requests.should.have.length_of(1)
+
+
+def test_async_count_is_always_a_coroutine():
+    response = {'hits': {'total': 2, 'hits': ['hit1', 'hit2']}}
+    with StubServer([{'count': 2}, response]) as server:
+        queryset = make_queryset(server.url).query('ice')
+
+        # When I count a lazy queryset before and after fetching it
+        before = run(queryset, queryset.count())
+        run(queryset, queryset.fetch())
+        after = run(queryset, queryset.count())
+
+    # Then I see the same total, and only the first one asked `_count`
+    before.should.equal(2)
+    after.should.equal(2)
+    [r['path'] for r in server.requests].should.equal(
+        ['/default/_count', '/default/_search'])
+
+
+def test_async_querysets_share_the_default_registry():
+    conf = Mock(indexes=['default'])
+
+    # When I create querysets without a registry
+    queryset1 = AsyncQuerySet(conf=conf)
+    queryset2 = AsyncQuerySet(conf=conf)
+
+    # Then I see that they share the same one
+    queryset1.registry.should.be(queryset2.registry)
+
+
+def test_async_registry_forgets_closed_loops():
+    registry = AsyncClientRegistry()
+
+    async def get():
+        client = registry.get('http://localhost:9200')
+        await client.session.close()
+
+    # Given that I used the registry in a loop that is now closed
+    asyncio.run(get())
+    len(registry._clients).should.equal(1)
+
+    # When I use it in another loop
+    asyncio.run(get())
+
+    # Then I see that the client of the closed loop was dropped
+    len(registry._clients).should.equal(1)
+
+
+def test_async_iter_all_scrolls_through_every_hit():
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'user', '_id': '2'}
+    responses = [
+        {'_scroll_id': 'scroll1', 'hits': {'hits': [hit1]}},
+        {'_scroll_id': 'scroll2', 'hits': {'hits': [hit2]}},
+        {'_scroll_id': 'scroll2', 'hits': {'hits': []}},
+        {},
+    ]
+
+    class UserWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return obj['_type'] == 'user'
+
+        @classmethod
+        async def wrap(cls, objs):
+            return [dict(obj, wrapped=True) for obj in objs]
+
+    with StubServer(responses) as server:
+        queryset = make_queryset(server.url).wrap(UserWrapper)
+
+        async def iter_all():
+            return [item async for item in queryset.iter_all('ice', batch_size=1)]
+
+        # When I iterate over all the hits of a search
+        items = run(queryset, iter_all())
+
+    # Then I see every hit, wrapped
+    items.should.equal([dict(hit1, wrapped=True), dict(hit2, wrapped=True)])
+
+    # And I see that the scroll was followed and then cleared
+    [(r['method'], r['path']) for r in server.requests].should.equal([
+        ('GET', '/default/_search'),
+        ('GET', '/_search/scroll'),
+        ('GET', '/_search/scroll'),
+        ('DELETE', '/_search/scroll/scroll2'),
+    ])
+    server.requests[1]['body'].should.equal('scroll1')
+
+
+def test_async_iter_items():
+    response = {'hits': {'hits': [
+        {'_type': 'user', '_id': '1'},
+        {'_type': 'user', '_id': '2'},
+        {'_type': 'user', '_id': '3'},
+    ]}}
+
+    class UserWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return obj['_type'] == 'user'
+
+        @classmethod
+        async def wrap(cls, objs):
+            return [dict(obj, chunk=len(objs)) for obj in objs]
+
+    with StubServer(response) as server:
+        queryset = make_queryset(server.url).wrap(UserWrapper)
+
+        async def iter_items():
+            await queryset.search('ice')
+            return [item async for item in queryset.iter_items(chunk_size=2)]
+
+        # When I iterate over the items in chunks
+        items = run(queryset, iter_items())
+
+    # Then I see the items of each chunk wrapped together
+    [(item['_id'], item['chunk']) for item in items].should.equal([
+        ('1', 2), ('2', 2), ('3', 1)])
+
+
+def test_async_cached_wrapper():
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'user', '_id': '2'}
+    calls = []
+
+    class UserWrapper(Wrapper):
+        @classmethod
+        def match(cls, obj):
+            return obj['_type'] == 'user'
+
+        @classmethod
+        async def wrap(cls, objs):
+            calls.append(objs)
+            return [dict(obj, wrapped=True) for obj in objs]
+
+    # Given that I have an async cached wrapper that already wrapped a hit
+    wrapper = AsyncCachedWrapper(UserWrapper, backend=LRUCache())
+    asyncio.run(wrapper.wrap([hit2]))
+
+    # When I use it in an async queryset
+    queryset = make_queryset('http://localhost:9200').wrap(wrapper)
+    queryset.raw_results = {'hits': {'hits': [hit1, hit2]}}
+    items = asyncio.run(queryset.items())
+
+    # Then I see that only the new hit was wrapped, keeping the order
+    calls.should.equal([[hit2], [hit1]])
+    items.should.equal([dict(hit1, wrapped=True), dict(hit2, wrapped=True)])
+
+    # And I see that the regular cached wrapper refuses coroutine wrappers
+    CachedWrapper(UserWrapper).wrap.when.called_with([hit1]).should.throw(
+        TypeError, 'AsyncCachedWrapper')
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+
+from elasticfun.cache import LRUCache, SearchCache
+
+
+def test_lru_cache_get_and_set():
+    # Given that I have a cache with an item
+    cache = LRUCache()
+    cache.set('key', 'value')
+
+    # When I read it back, Then I see the same value
+    cache.get('key').should.equal('value')
+    cache.get('missing').should.be.none
+    cache.get('missing', 'default').should.equal('default')
+    ('key' in cache).should.be.true
+
+
+def test_lru_cache_evicts_least_recently_used():
+    # Given that I have a cache that holds two items
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # When I use the oldest item and add a new one
+    cache.get('a')
+    cache.set('c', 3)
+
+    # Then I see that the least recently used one was dropped
+    len(cache).should.equal(2)
+    cache.get('b').should.be.none
+    cache.get('a').should.equal(1)
+    cache.get('c').should.equal(3)
+
+
+def test_lru_cache_delete_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.delete('a')
+    cache.get('a').should.be.none
+
+    cache.clear()
+    len(cache).should.equal(0)
+
+
+@patch('elasticfun.cache.time')
+def test_lru_cache_ttl(time):
+    # Given that I have a cache whose items expire after 10 seconds
+    cache = LRUCache(ttl=10)
+    time.time.return_value = 100
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=60)
+
+    # When 11 seconds have passed, Then I see that only the item with
+    # the longer ttl is still there
+    time.time.return_value = 111
+    cache.get('a').should.be.none
+    cache.get('b').should.equal(2)
+    ('a' in cache).should.be.false
+
+
+def test_lru_cache_get_and_set_many():
+    cache = LRUCache()
+    cache.set_many({'a': 1, 'b': 2})
+
+    cache.get_many(['a', 'b', 'c']).should.equal({'a': 1, 'b': 2})
+
+
+def test_lru_cache_max_weight():
+    # Given that I have a cache holding at most 10 characters
+    cache = LRUCache(maxweight=10)
+    cache.set('a', 'x' * 4)
+    cache.set('b', 'x' * 4)
+
+    # When I add a value that doesn't fit with the other ones
+    cache.set('c', 'x' * 4)
+
+    # Then I see that the least recently used one was dropped
+    cache.get('a').should.be.none
+    cache.get('b').should.equal('x' * 4)
+    cache.get('c').should.equal('x' * 4)
+
+    # And I see that values heavier than the whole cache aren't kept
+    cache.set('d', 'x' * 11)
+    cache.get('d').should.be.none
+    cache.get('c').should.equal('x' * 4)
+    cache._weight.should.equal(8)
+
+
+def test_search_cache_invalidating_everything_while_searching():
+    # Given that a search started before the whole cache was invalidated
+    cache = SearchCache()
+    key = cache.entry_key('default', 'ice')
+    cache.invalidate()
+
+    # When it stores its response
+    cache.set(key, 'old')
+
+    # Then I see that the next searches don't get it
+    cache.get(cache.entry_key('default', 'ice')).should.equal((None, False))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import warnings
+
+from mock import patch, call, Mock
+
+from elasticfun import ClientRegistry, Indexer, QuerySet
+from elasticfun.connections import send_encoded
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_reuses_clients(pyelasticsearch):
+    # Given that I have a client registry
+    registry = ClientRegistry()
+
+    # When I ask for the same URL twice
+    client1 = registry.get('http://localhost:9200')
+    client2 = registry.get('http://localhost:9200')
+
+    # Then I see that only one client was created
+    client1.should.equal(client2)
+    pyelasticsearch.ElasticSearch.assert_called_once_with(
+        'http://localhost:9200')
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_one_client_per_url(pyelasticsearch):
+    registry = ClientRegistry()
+
+    # When I ask for two different URLs
+    registry.get('http://localhost:9200')
+    registry.get('http://localhost:9201')
+
+    # Then I see that each one got its own client
+    pyelasticsearch.ElasticSearch.call_args_list.should.equal([
+        call('http://localhost:9200'),
+        call('http://localhost:9201'),
+    ])
+
+
+@patch('elasticfun.connections.HTTPAdapter')
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_pool_size(pyelasticsearch, HTTPAdapter):
+    # Given that I have a registry with a custom pool size
+    registry = ClientRegistry(maxsize=25)
+
+    # When a new client is created
+    client = registry.get('http://localhost:9200')
+
+    # Then I see that its session got a pool with the right size
+    HTTPAdapter.assert_called_once_with(pool_connections=1, pool_maxsize=25)
+    client.session.mount.assert_any_call('http://', HTTPAdapter.return_value)
+    client.session.mount.assert_any_call('https://', HTTPAdapter.return_value)
+
+
+@patch('elasticfun.connections.time')
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_idle_timeout(pyelasticsearch, time):
+    # Given that I have a registry that expires clients after 10 seconds
+    registry = ClientRegistry(idle_timeout=10)
+    time.time.return_value = 100
+    old_client = registry.get('http://localhost:9200')
+
+    # When I use the same URL after the client was idle for too long
+    fresh_client = pyelasticsearch.ElasticSearch.return_value = Mock()
+    time.time.return_value = 111
+    new_client = registry.get('http://localhost:9200')
+
+    # Then I see that the old session was closed and a new client created
+    old_client.session.close.assert_called_once_with()
+    new_client.should.be(fresh_client)
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_close(pyelasticsearch):
+    # Given that I have a registry with an open client
+    registry = ClientRegistry()
+    client = registry.get('http://localhost:9200')
+
+    # When I close the registry
+    registry.close()
+
+    # Then I see that the session was closed and the next call will
+    # create a new client
+    client.session.close.assert_called_once_with()
+    registry.get('http://localhost:9200')
+    pyelasticsearch.ElasticSearch.call_count.should.equal(2)
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_warm(pyelasticsearch):
+    # Given that I have a connections dict
+    connections = {
+        'default': {'URL': 'http://localhost:9200'},
+    }
+
+    # When I warm up the registry
+    registry = ClientRegistry()
+    registry.warm(connections)
+
+    # Then I see that the client was already created
+    pyelasticsearch.ElasticSearch.assert_called_once_with(
+        'http://localhost:9200')
+
+
+@patch('elasticfun.connections.lazy_loads')
+@patch('elasticfun.connections.pyelasticsearch')
+def test_lazy_clients_decode_with_lazy_loads(pyelasticsearch, lazy_loads):
+    # Given that I have a registry of lazy clients
+    registry = ClientRegistry(lazy=True)
+    client = registry.get('http://localhost:9200')
+
+    # When a client decodes a response, Then I see it used lazy_loads
+    response = Mock(content=b'{"hits": {}}')
+    client._decode_response(response).should.be(lazy_loads.return_value)
+    lazy_loads.assert_called_once_with(b'{"hits": {}}')
+
+    # And I see that invalid responses raise the usual error
+    lazy_loads.side_effect = ValueError
+    pyelasticsearch.InvalidJsonResponseError = type(
+        str('InvalidJsonResponseError'), (Exception,), {})
+    client._decode_response.when.called_with(response).should.throw(
+        pyelasticsearch.InvalidJsonResponseError)
+
+
+@patch('elasticfun.connections._registry', None)
+def test_querysets_and_indexers_share_the_default_registry():
+    conf = Mock(indexes=['default'])
+
+    # When I create querysets and indexers without a registry
+    registries = [
+        QuerySet(conf=conf).registry,
+        QuerySet(conf=conf).registry,
+        Indexer(conf=conf).registry,
+    ]
+
+    # Then I see that they all share the same one
+    registries[0].should.be.a(ClientRegistry)
+    registries[1].should.be(registries[0])
+    registries[2].should.be(registries[0])
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_registry_warns_when_the_pool_cannot_be_configured(pyelasticsearch):
+    # Given that the clients have no session, like the ones of
+    # pyelasticsearch 1.x
+    pyelasticsearch.ElasticSearch.return_value = Mock(spec=['send_request'])
+
+    # When a new client is created
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        ClientRegistry(maxsize=25).get('http://localhost:9200')
+
+    # Then I see a warning saying the pool size has no effect
+    [w.category for w in caught].should.equal([RuntimeWarning])
+    str(caught[0].message).should.contain('`maxsize`')
+
+
+def test_send_encoded_with_both_pyelasticsearch_apis():
+    # Given the clients of pyelasticsearch 0.4, which encode the bodies
+    # unless told not to, and of 1.x, which send strings as they are
+    class OldClient(object):
+        def send_request(self, method, path_components, body='',
+                         query_params=None, encode_body=True):
+            return method, path_components, body, query_params, encode_body
+
+    class NewClient(object):
+        def send_request(self, method, path_components, body='',
+                         query_params=None):
+            return method, path_components, body, query_params
+
+    # When I send an encoded body with each of them
+    old = send_encoded(OldClient(), 'POST', ['_bulk'], b'{}\n', {'a': 1})
+    new = send_encoded(NewClient(), 'POST', ['_bulk'], b'{}\n', {'a': 1})
+
+    # Then I see that the body was sent as a string, and only the old
+    # client was told not to encode it
+    old.should.equal(('POST', ['_bulk'], '{}\n', {'a': 1}, False))
+    new.should.equal(('POST', ['_bulk'], '{}\n', {'a': 1}))
+
+
+@patch('elasticfun.connections.lazy_loads')
+@patch('elasticfun.connections.pyelasticsearch')
+def test_lazy_clients_of_pyelasticsearch_1(pyelasticsearch, lazy_loads):
+    # Given that the clients decode the responses through the
+    # deserializer of their transport, like the ones of pyelasticsearch 1.x
+    json_serializer = Mock()
+    deserializer = Mock(
+        default=json_serializer,
+        serializers={'application/json': json_serializer})
+    pyelasticsearch.ElasticSearch.return_value = Mock(
+        spec=['_transport', 'session'],
+        _transport=Mock(deserializer=deserializer))
+
+    # When a lazy registry creates a client
+    ClientRegistry(lazy=True).get('http://localhost:9200')
+
+    # Then I see that its JSON responses are decoded with lazy_loads
+    lazy = deserializer.serializers['application/json']
+    deserializer.default.should.be(lazy)
+    lazy.loads('{"hits": {}}').should.be(lazy_loads.return_value)
+    lazy_loads.assert_called_once_with('{"hits": {}}')
+
+    # And I see that invalid responses raise the error of the original
+    # serializer
+    lazy_loads.side_effect = ValueError
+    json_serializer.loads.side_effect = KeyError
+    lazy.loads.when.called_with('{').should.throw(KeyError)
+
+
+@patch('elasticfun.connections.pyelasticsearch')
+def test_lazy_clients_that_cannot_decode_lazily(pyelasticsearch):
+    pyelasticsearch.ElasticSearch.return_value = Mock(spec=['session'])
+
+    # When a lazy registry creates a client it can't hook into, Then I see
+    # a warning
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        ClientRegistry(lazy=True).get('http://localhost:9200')
+    [w.category for w in caught].should.equal([RuntimeWarning])
+    str(caught[0].message).should.contain('`lazy`')
@@ -3,6 +3,7 @@ from django.core.exceptions import ImproperlyConfigured
 from mock import patch, Mock
 
 from elasticfun.django import QuerySet, ConfManager
+from elasticfun.django.cache import DjangoCache
 
 
 @patch('elasticfun.django.settings')
@@ -35,3 +36,35 @@ def test_django_search_against_an_invalid_index():
         "There's no index called `blah`, the available ones are: default, other_index. "
         "Check the ELASTICFUN_CONNECTIONS variable in your settings file."
     )
+
+
+@patch.object(ConfManager, '_registry', None)
+@patch('elasticfun.django.settings', Mock(ELASTICFUN_POOL={'maxsize': 5}))
+def test_django_querysets_share_the_registry():
+    # When I create two querysets with the default configuration
+    queryset1 = QuerySet()
+    queryset2 = QuerySet()
+
+    # Then I see that they share the same client registry, configured
+    # through the settings file
+    queryset1.registry.should.be(queryset2.registry)
+    queryset1.registry.maxsize.should.equal(5)
+
+
+@patch('elasticfun.django.cache.caches')
+def test_django_cache_adapter(caches):
+    # Given that I have an adapter for one of the django caches
+    backend = DjangoCache('wrappers', timeout=60)
+    cache = caches.__getitem__.return_value
+    cache.get_many.return_value = {'a': 1}
+
+    # When I use it as a wrapper cache backend, Then I see that it calls
+    # the right django cache
+    backend.get_many(['a', 'b']).should.equal({'a': 1})
+    backend.set_many({'b': 2})
+    backend.delete('a')
+
+    caches.__getitem__.assert_called_with('wrappers')
+    cache.get_many.assert_called_once_with(['a', 'b'])
+    cache.set_many.assert_called_once_with({'b': 2}, timeout=60)
+    cache.delete.assert_called_once_with('a')
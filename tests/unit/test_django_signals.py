@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from mock import patch, Mock
+
+from elasticfun.django.signals import IndexUpdates
+
+
+class User(object):
+    class _meta:
+        app_label = 'accounts'
+
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+
+
+def make_updates():
+    updates = IndexUpdates(indexer=Mock())
+    updates.indexer.bulk.return_value = (1, [])
+    updates.register(User, lambda user: {'name': user.name}, index='people')
+    return updates
+
+
+@patch('elasticfun.django.signals.transaction')
+def test_events_are_merged_and_sent_in_a_single_batch(transaction):
+    transaction.get_connection.return_value.in_atomic_block = False
+    updates = make_updates()
+
+    # When a few users are saved and deleted while collecting the events
+    with updates.collect():
+        updates._saved(User, User(1, 'Lincoln'))
+        updates._saved(User, User(2, 'Gabriel'))
+        updates._saved(User, User(1, 'Lincoln Clarete'))
+        updates._deleted(User, User(2, 'Gabriel'))
+        updates.indexer.bulk.called.should.be.false
+
+    # Then I see that a single request was sent with the last event of
+    # each document
+    updates.indexer.bulk.assert_called_once_with([
+        {'_op_type': 'index', '_type': 'user', '_id': 1,
+         '_source': {'name': 'Lincoln Clarete'}},
+        {'_op_type': 'delete', '_type': 'user', '_id': 2},
+    ], index='people')
+    updates.unregister(User)
+
+
+@patch('elasticfun.django.signals.transaction')
+def test_events_wait_for_the_transaction(transaction):
+    connection = transaction.get_connection.return_value
+    connection.in_atomic_block = True
+    updates = make_updates()
+
+    # When a user is saved inside of a transaction
+    with updates.collect():
+        updates._saved(User, User(1, 'Lincoln'), using='default')
+
+    # Then I see that nothing is sent until the transaction is committed
+    updates.indexer.bulk.called.should.be.false
+    transaction.on_commit.call_count.should.equal(2)
+    for (callback,), kwargs in transaction.on_commit.call_args_list:
+        callback()
+    updates.indexer.bulk.assert_called_once_with([
+        {'_op_type': 'index', '_type': 'user', '_id': 1,
+         '_source': {'name': 'Lincoln'}},
+    ], index='people')
+    updates.unregister(User)
+
+
+@patch('elasticfun.django.signals.transaction')
+def test_events_sent_to_a_queue(transaction):
+    transaction.get_connection.return_value.in_atomic_block = False
+    queue = Mock()
+    updates = IndexUpdates(queue=queue)
+    updates.register(User, lambda user: {'name': user.name})
+
+    # When a user is saved without collecting the events, Then I see
+    # that it's passed to the queue right away
+    updates._saved(User, User(1, 'Lincoln'))
+    queue.assert_called_once_with([
+        {'_op_type': 'index', '_type': 'user', '_id': 1,
+         '_source': {'name': 'Lincoln'}},
+    ], 'default')
+    updates.unregister(User)
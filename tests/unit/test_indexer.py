@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+from mock import patch, Mock, ANY, call
+from pyelasticsearch import ElasticHttpError
+
+from elasticfun import ConfigMissingException, ImproperlyConfigured
+from elasticfun.indexer import Indexer
+
+
+def make_indexer(**kwargs):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    return Indexer(conf=conf, **kwargs)
+
+
+def bulk_lines(request):
+    body = request[0][2]
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def ok(*ids):
+    return {'items': [
+        {'index': {'_id': str(id_), 'status': 201}} for id_ in ids]}
+
+
+def test_create_indexer_with_no_conf():
+    Indexer.when.called_with(conf=None).should.throw(ConfigMissingException)
+
+
+def test_bulk_against_an_invalid_index():
+    make_indexer().bulk.when.called_with([], index='nope').should.throw(
+        ImproperlyConfigured,
+        "There's no index called `nope`, the available ones are: default.")
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_bulk_serializes_the_actions(pyelasticsearch):
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.return_value = ok(1, 2, 3)
+
+    # When I send actions of different kinds
+    indexer = make_indexer(workers=1)
+    success, errors = indexer.bulk([
+        {'_type': 'user', '_id': 1, 'name': 'Lincoln'},
+        {'_type': 'user', '_id': 2, '_op_type': 'update',
+         '_source': {'doc': {'name': 'Gabriel'}}},
+        {'_type': 'user', '_id': 3, '_op_type': 'delete'},
+    ])
+
+    # Then I see that they were sent in a single bulk request
+    success.should.equal(3)
+    errors.should.equal([])
+    esinst.send_request.assert_called_once_with(
+        'POST', ['_bulk'], ANY, None)
+    bulk_lines(esinst.send_request.call_args).should.equal([
+        {'index': {'_index': 'default', '_type': 'user', '_id': 1}},
+        {'name': 'Lincoln'},
+        {'update': {'_index': 'default', '_type': 'user', '_id': 2}},
+        {'doc': {'name': 'Gabriel'}},
+        {'delete': {'_index': 'default', '_type': 'user', '_id': 3}},
+    ])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_bulk_flushes_by_count_and_size(pyelasticsearch):
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.side_effect = lambda *args, **kwargs: ok(
+        *range(len(args[2].splitlines()) // 2))
+    docs = ({'_id': i, 'text': 'x' * 50} for i in range(10))
+
+    # When I index a generator of documents with small limits
+    indexer = make_indexer(workers=1, max_docs=4, max_bytes=400)
+    success, errors = indexer.bulk(docs)
+
+    # Then I see that no request went over the limits
+    success.should.equal(10)
+    sizes = [len(bulk_lines(request)) // 2
+             for request in esinst.send_request.call_args_list]
+    sizes.should.equal([3, 3, 3, 1])
+    for request in esinst.send_request.call_args_list:
+        (len(request[0][2]) <= 400).should.be.true
+
+    # And I see that small documents are grouped by count
+    esinst.send_request.reset_mock()
+    indexer.max_bytes = 5 * 1024 * 1024
+    indexer.bulk({'_id': i} for i in range(10))
+    sizes = [len(bulk_lines(request)) // 2
+             for request in esinst.send_request.call_args_list]
+    sizes.should.equal([4, 4, 2])
+
+
+@patch('elasticfun.indexer.time')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_bulk_retries_rejected_items(pyelasticsearch, time):
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    rejected = {'_id': '2', 'status': 429, 'error': 'EsRejectedExecutionException'}
+    failed = {'_id': '3', 'status': 400, 'error': 'MapperParsingException'}
+    esinst.send_request.side_effect = [
+        {'items': [{'index': {'_id': '1', 'status': 201}},
+                   {'index': rejected}, {'index': failed}]},
+        {'items': [{'index': rejected}]},
+        ok(2),
+    ]
+
+    # When the cluster rejects an item a couple of times
+    indexer = make_indexer(workers=1, backoff=0.5)
+    success, errors = indexer.bulk([{'_id': i} for i in (1, 2, 3)])
+
+    # Then I see that only the rejected item was sent again, waiting
+    # longer after each rejection
+    success.should.equal(2)
+    errors.should.equal([{'index': failed}])
+    [len(bulk_lines(request)) for request in esinst.send_request.call_args_list] \
+        .should.equal([6, 2, 2])
+    time.sleep.call_args_list.should.equal([call(0.5), call(1.0)])
+
+
+@patch('elasticfun.indexer.time')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_bulk_gives_up_after_max_retries(pyelasticsearch, time):
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.side_effect = ElasticHttpError(429, 'busy')
+
+    # When the cluster keeps rejecting the requests, Then I see the error
+    indexer = make_indexer(workers=1, max_retries=2)
+    indexer.bulk.when.called_with([{'_id': 1}]).should.throw(ElasticHttpError)
+    esinst.send_request.call_count.should.equal(3)
+
+    # And I see that other errors are not retried
+    esinst.send_request.reset_mock()
+    esinst.send_request.side_effect = ElasticHttpError(400, 'bad request')
+    indexer.bulk.when.called_with([{'_id': 1}]).should.throw(ElasticHttpError)
+    esinst.send_request.call_count.should.equal(1)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_bulk_sends_concurrently(pyelasticsearch):
+    # Given that the cluster only answers when two requests are running
+    # at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def send_request(*args, **kwargs):
+        barrier.wait()
+        return ok(1)
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.side_effect = send_request
+
+    # When I index with two workers, Then I see all the requests went through
+    indexer = make_indexer(workers=2, max_docs=1)
+    indexer.bulk([{'_id': 1}, {'_id': 2}]).should.equal((2, []))
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from six import text_type
+import operator
+import random
 from datetime import datetime
+from decimal import Decimal
+from functools import reduce
+
+from six import text_type
+from mock import patch
+
 from elasticfun import Query, ParsingException
+from elasticfun.cache import LRUCache
 
 
 def test_query_all():
@@ -37,6 +45,35 @@ def test_escape_query():
     query.should.equal('"\+\-\&\|\!\(\)\{\}\[\]\^\\\"\~\*\?\:\\\\"')
 
 
+def test_escape_elasticsearch_reserved_chars():
+    # When I query by the characters elasticsearch also reserves
+    query = text_type(Query('a/b <c> =d'))
+
+    # Then I see that they were escaped as well
+    query.should.equal('"a\\/b \\<c\\> \\=d"')
+
+
+def test_escape_matches_the_reference_implementation():
+    # The character by character escaper we used to have, kept here as
+    # the reference for the faster one
+    def reference(s):
+        r = []
+        for c in s:
+            if c in '+-&|!(){}[]^"~*?:\\/<>=':
+                r.append('\\')
+            r.append(c)
+        return ''.join(r)
+
+    # Given random strings mixing regular, special and unicode chars
+    rand = random.Random(42)
+    alphabet = 'ab c1\u0170\u00e9' + '+-&|!(){}[]^"~*?:\\/<>='
+    for _ in range(2000):
+        s = ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 30)))
+
+        # Then I see that both escapers give the same output
+        Query('')._escape(s).should.equal(reference(s))
+
+
 def test_mixing_words_and_fields():
     # When I try to filter by both words and fields in the same object,
     # Than I see that it actually raised an exception
@@ -325,3 +362,196 @@ def test_query_with_endswith_lookup():
 
     # Then I see the field queried with the value prepended with a wildcard
     text_type(query).should.equal('title:("*cream")')
+
+
+def test_query_structural_key():
+    # When I build the same queries twice, Then I see that they have the
+    # same key
+    (Query('ice') & Query(brand='cream')).key.should.equal(
+        (Query('ice') & Query(brand='cream')).key)
+
+    # And I see that different values have different keys, even if
+    # they're equal in python
+    Query(a=True).key.shouldnt.equal(Query(a=1).key)
+    Query(a=[1, 2]).key.shouldnt.equal(Query(a=(1, 2)).key)
+    (Query('a') & Query('b')).key.shouldnt.equal((Query('a') | Query('b')).key)
+
+
+def test_query_key_with_unhashable_values():
+    # When a query holds a value that can't be hashed, Then I see that
+    # it doesn't have a key but can still be compiled
+    query = Query(brand={'a': 1}) & Query('b')
+    query.key.should.be.none
+    text_type(query).should.equal('(brand:"\\{\'a\'\\: 1\\}" AND "b")')
+
+
+@patch.object(Query, 'compiled', LRUCache())
+def test_query_reuses_compiled_strings():
+    # Given that I compiled a query once
+    text_type(Query('ice') & Query(title__in=['a', 'b']))
+
+    # When I build and compile the same query again
+    with patch.object(Query, '_eval') as _eval:
+        querystr = text_type(Query('ice') & Query(title__in=['a', 'b']))
+
+    # Then I see that the leaves were not evaluated again
+    _eval.called.should.be.false
+    querystr.should.equal('("ice" AND title:("a" OR "b"))')
+
+
+@patch.object(Query, 'compiled', None)
+def test_query_without_the_compiled_cache():
+    text_type(Query('ice') & ~Query('cream')).should.equal(
+        '("ice" AND (NOT "cream"))')
+
+
+def test_query_combinations_dont_change_the_operands():
+    # Given that I have a query
+    ice = Query('ice')
+
+    # When I combine it with other queries
+    both = ice & Query('cream')
+    either = ice | Query('cream')
+    negated = ~ice
+
+    # Then I see that the original query didn't change and can still be
+    # shared by all the combinations
+    text_type(ice).should.equal('"ice"')
+    text_type(both).should.equal('("ice" AND "cream")')
+    text_type(either).should.equal('("ice" OR "cream")')
+    text_type(negated).should.equal('(NOT "ice")')
+    both.children.should.equal((ice, both.children[1]))
+
+
+def test_query_with_long_chains():
+    # When I combine a lot of queries
+    query = reduce(operator.and_, [Query('t{}'.format(i)) for i in range(5000)])
+
+    # Then I see that the whole chain is compiled without hitting the
+    # recursion limit, in a single group
+    querystr = text_type(query)
+    querystr.should.equal('({})'.format(
+        ' AND '.join('"t{}"'.format(i) for i in range(5000))))
+    query.key.should_not.be.none
+
+
+def test_query_flattens_chains_of_the_same_operator():
+    a, b, c, d = Query('a'), Query('b'), Query('c'), Query('d')
+
+    # When I chain queries with the same operator, no matter how they
+    # were grouped, Then I see that they're written in a single group
+    text_type(a & b & c & d).should.equal('("a" AND "b" AND "c" AND "d")')
+    text_type((a & b) & (c & d)).should.equal('("a" AND "b" AND "c" AND "d")')
+    text_type(a | (b | c)).should.equal('("a" OR "b" OR "c")')
+
+    # And I see that different operators still get their own groups
+    text_type((a & b) | c | (d & a)).should.equal(
+        '(("a" AND "b") OR "c" OR ("d" AND "a"))')
+    text_type(a & ~(b & c) & d).should.equal(
+        '("a" AND (NOT ("b" AND "c")) AND "d")')
+    text_type(Query(brand=(a | b | c))).should.equal('brand:("a" OR "b" OR "c")')
+
+
+def test_query_to_dsl_leaves():
+    # When I compile field queries to the query DSL, Then I see that
+    # each lookup becomes the right clause
+    Query(brand='blah').to_dsl().should.equal({'term': {'brand': 'blah'}})
+    Query(active=True).to_dsl().should.equal({'term': {'active': True}})
+    Query(cat__in=['a', 'b']).to_dsl().should.equal(
+        {'terms': {'cat': ['a', 'b']}})
+    Query(cat__in=[]).to_dsl().should.equal({'terms': {'cat': []}})
+    Query(pub_date__lte=datetime(2013, 3, 13, 1, 32)).to_dsl().should.equal(
+        {'range': {'pub_date': {'lte': '2013-03-13T01:32:00'}}})
+    Query(price__gt=10).to_dsl().should.equal({'range': {'price': {'gt': 10}}})
+    Query(price__range=[1, 5]).to_dsl().should.equal(
+        {'range': {'price': {'gte': 1, 'lte': 5}}})
+    Query(title__startswith='cre').to_dsl().should.equal(
+        {'prefix': {'title': 'cre'}})
+    Query(title__endswith='am').to_dsl().should.equal(
+        {'wildcard': {'title': '*am'}})
+
+
+def test_query_to_dsl_fallbacks():
+    # When I compile queries that can't be expressed as exact clauses,
+    # Then I see that they become query_string clauses
+    Query('ice cream').to_dsl().should.equal(
+        {'query_string': {'query': '"ice cream"'}})
+    Query('stuff', _boost=('field', 3)).to_dsl().should.equal(
+        {'query_string': {'query': '"stuff" field^3'}})
+    Query().to_dsl().should.equal({'match_all': {}})
+    Query.empty().to_dsl().should.equal({'match_all': {}})
+
+
+def test_query_to_dsl_bool():
+    # When I compile combined queries
+    query = Query(a=1) & Query(b=2) & ~(Query(c=3) | Query(d=4))
+
+    # Then I see that they become bool clauses, with the chains of the
+    # same operator flattened
+    query.to_dsl().should.equal({'bool': {'must': [
+        {'term': {'a': 1}},
+        {'term': {'b': 2}},
+        {'bool': {'must_not': [{'bool': {
+            'should': [{'term': {'c': 3}}, {'term': {'d': 4}}],
+            'minimum_should_match': 1,
+        }}]}},
+    ]}})
+
+
+def test_query_optimize_merges_terms_of_the_same_field():
+    # Given that I have an OR group with many values for the same field
+    query = (
+        Query(cat='a') | Query(cat='b') | Query('x') |
+        Query(cat__in=['c', 'a']) | Query(tag=1)
+    ) & Query(z=1)
+
+    # When I optimize it, Then I see that the values of the same field
+    # were merged into a single group without duplicates
+    text_type(query.optimize()).should.equal(
+        '((cat:("a" OR "b" OR "c") OR "x" OR tag:"1") AND z:"1")')
+
+
+def test_query_optimize_keeps_what_cant_be_merged():
+    # When the OR group has a single value per field, or the values are
+    # combined with AND, Then I see that nothing changes
+    query = (Query(cat='a') | Query(tag='b')) & Query(cat='c') & ~Query(cat='d')
+    text_type(query.optimize()).should.equal(text_type(query))
+
+    # And I see that boosted values and lookups other than `in` are kept
+    query = Query(cat='a', _boost=('cat', 2)) | Query(cat='b') | Query(cat__gte='c')
+    text_type(query.optimize()).should.equal(text_type(query))
+
+
+def test_query_to_dsl_merges_terms():
+    # When I compile an OR group of the same field to the DSL
+    query = Query(user_id=1) | Query(user_id=2) | Query(user_id__in=[3, 4])
+
+    # Then I see a single terms clause
+    query.to_dsl().should.equal({'terms': {'user_id': [1, 2, 3, 4]}})
+
+
+def test_query_has_no_instance_dict():
+    # Queries are compact objects, they can't get new attributes
+    query = Query(brand='blah') & Query('stuff')
+    query.should_not.have.property('__dict__')
+    Query.__setattr__.when.called_with(query, 'blah', 1).should.throw(
+        AttributeError)
+
+
+def test_query_interns_field_names():
+    # When I create two queries on the same field, Then I see that they
+    # share the same field and lookup strings
+    first, second = Query(**{'pub_' + 'date__lte': 1}), Query(pub_date__lte=2)
+    first.field.should.be(second.field)
+    first.lookup.should.be(second.lookup)
+
+
+@patch.object(Query, 'compiled', LRUCache())
+def test_query_reuses_compiled_strings_only_for_the_same_text():
+    # When I compile values that are equal but print differently
+    text_type(Query(price=Decimal('1.0'))).should.equal('price:"1.0"')
+
+    # Then I see that each one got its own string
+    text_type(Query(price=Decimal('1.00'))).should.equal('price:"1.00"')
+    text_type(Query(price=0.0)).should.equal('price:"0.0"')
+    text_type(Query(price=-0.0)).should.equal('price:"\\-0.0"')
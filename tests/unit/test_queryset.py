@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-from mock import patch, Mock
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mock import patch, Mock, ANY, call
+from pyelasticsearch import ElasticHttpError
 
 from elasticfun import (
     ConfigMissingException,
@@ -7,8 +12,12 @@ from elasticfun import (
     ImproperlyConfigured,
     Query,
     QuerySet,
+    SingleFlight,
     Wrapper
 )
+from elasticfun.cache import SearchCache
+from elasticfun.queryset import build_search_body, search_query
+from elasticfun.singleflight import _Call
 
 
 def test_create_queryset_with_no_conf():
@@ -38,7 +47,8 @@ def test_searching_against_an_invalid_index():
         "There's no index called `blah`, the available ones are: default, other_index.")
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_search_api(pyelasticsearch):
     # Given that I want to query for something on elasticsearch, I need
     # to add some configuration to my settings file.
@@ -66,7 +76,8 @@ def test_search_api(pyelasticsearch):
     results.raw_results.should.equal('a lot of awesome stuff')
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_connection_with_index_name(pyelasticsearch):
     # Given that we might want to name a connection with a different
     # string then the one used to identify my indexes
@@ -90,7 +101,8 @@ def test_connection_with_index_name(pyelasticsearch):
         'something', index='stuff')
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_searching_with_query_objects(pyelasticsearch):
 
     connections = {
@@ -110,7 +122,8 @@ def test_searching_with_query_objects(pyelasticsearch):
         '("ice" AND "cream")', index='default')
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_searching_with_dicts(pyelasticsearch):
     connections = {
         'default': {'URL': 'http://localhost:9200'}}
@@ -140,7 +153,8 @@ def test_queryset_count_without_searching_before():
     queryset.count().should.equal(0)
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_queryset_count(pyelasticsearch):
     connections = {
         'default': {'URL': 'http://localhost:9200'}}
@@ -166,7 +180,8 @@ def test_queryset_max_score_without_searching_before():
     queryset.max_score().should.equal(0)
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_queryset_max_score(pyelasticsearch):
     connections = {
         'default': {'URL': 'http://localhost:9200'}}
@@ -194,7 +209,8 @@ def test_queryset_wrap():
     queryset.wrappers.should.equal(['a wrapper', 'another wrapper'])
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_get_items_without_searching_before(pyelasticsearch):
     # Given that we have a well configured queryset object
     connections = {
@@ -212,7 +228,8 @@ def test_get_items_without_searching_before(pyelasticsearch):
         )
 
 
-@patch('elasticfun.queryset.pyelasticsearch')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
 def test_get_items_without_wrap_before(pyelasticsearch):
     # Given that we have a well configured queryset object
     connections = {
@@ -378,3 +395,892 @@ def test_get_items_false_clean():
     results = queryset.wrap(wrapper).items(clean=False)
 
     results.should.equal([hit1, None])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_searches_reuse_the_same_client(pyelasticsearch):
+    # Given that I have a queryset
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    # When I search twice
+    queryset.search('something')
+    queryset.search('something else')
+
+    # Then I see that the client was created just once
+    pyelasticsearch.ElasticSearch.assert_called_once_with(
+        'http://localhost:9200')
+    pyelasticsearch.ElasticSearch.return_value.search.call_count.should.equal(2)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_msearch_sends_a_single_request(pyelasticsearch):
+    # Given that I have a queryset configured with two indexes living on
+    # the same cluster
+    connections = {
+        'default': {'URL': 'http://localhost:9200'},
+        'other': {'URL': 'http://localhost:9200'},
+    }
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.return_value = {'responses': [
+        {'hits': {'total': 1, 'max_score': 2.0, 'hits': ['hit1']}},
+        {'hits': {'total': 3, 'max_score': 1.0, 'hits': ['hit2']}},
+    ]}
+
+    # When I run two searches at once
+    results = queryset.msearch([
+        (Query('ice') & Query('cream'), 'default', {'es_size': 10}),
+        ('stuff', 'other', {'es_search_type': 'count'}),
+    ])
+
+    # Then I see that a single request was sent to the `_msearch`
+    # endpoint with both searches
+    esinst.send_request.assert_called_once_with(
+        'GET', ['_msearch'], ANY, None)
+    body = esinst.send_request.call_args[0][2]
+    [json.loads(line) for line in body.splitlines()].should.equal([
+        {'index': 'default'},
+        {'query': {'query_string': {'query': '("ice" AND "cream")'}},
+         'size': 10},
+        {'index': 'other', 'search_type': 'count'},
+        {'query': {'query_string': {'query': 'stuff'}}},
+    ])
+
+    # And I see that each search got its own queryset
+    results.should.have.length_of(2)
+    results[0].count().should.equal(1)
+    results[0].max_score().should.equal(2.0)
+    results[0].items().should.equal(['hit1'])
+    results[1].count().should.equal(3)
+    results[1].items().should.equal(['hit2'])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_msearch_one_request_per_cluster(pyelasticsearch):
+    # Given that I have two indexes living on different clusters
+    connections = {
+        'default': {'URL': 'http://localhost:9200'},
+        'other': {'URL': 'http://localhost:9201'},
+    }
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    first, second = Mock(), Mock()
+    first.send_request.return_value = {
+        'responses': [{'hits': {'total': 1}}, {'hits': {'total': 3}}]}
+    second.send_request.return_value = {
+        'responses': [{'hits': {'total': 2}}]}
+    pyelasticsearch.ElasticSearch.side_effect = [first, second]
+
+    # When I search both indexes at once
+    results = queryset.msearch([
+        ('a', 'default', {}),
+        ('b', 'other', {}),
+        ('c', 'default', {}),
+    ])
+
+    # Then I see that each cluster received one request and the results
+    # are kept in the order they were requested
+    first.send_request.call_count.should.equal(1)
+    second.send_request.call_count.should.equal(1)
+    [r.count() for r in results].should.equal([1, 2, 3])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_msearch_results_keep_the_wrappers(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+
+    hit = {'_type': 'type1', '_id': 'some_id'}
+    pyelasticsearch.ElasticSearch.return_value.send_request.return_value = {
+        'responses': [{'hits': {'hits': [hit]}}]}
+
+    wrapper = Wrapper()
+    wrapper.wrap = lambda objs: [dict(obj, wrapped=True) for obj in objs]
+    wrapper.match = lambda obj: True
+
+    # When I run a multi search on a queryset with a wrapper
+    results = QuerySet(conf=conf).wrap(wrapper).msearch([('a', 'default', {})])
+
+    # Then I see that the results are wrapped too
+    results[0].items().should.equal([dict(hit, wrapped=True)])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_msearch_with_errors(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    pyelasticsearch.ElasticSearch.return_value.send_request.return_value = {
+        'responses': [{'error': 'SearchPhaseExecutionException', 'status': 400}]}
+
+    # When one of the searches fails, Then I see that the error is raised
+    QuerySet(conf=conf).msearch.when.called_with([('a', 'default', {})]).should.throw(
+        ElasticHttpError)
+
+
+def test_msearch_against_an_invalid_index():
+    conf = Mock(indexes=['default'])
+    queryset = QuerySet(conf=conf)
+
+    queryset.msearch.when.called_with([('a', 'blah', {})]).should.throw(
+        ImproperlyConfigured,
+        "There's no index called `blah`, the available ones are: default.")
+
+
+def test_build_search_body_with_dicts_and_sort():
+    # When I build a search with a dict query and a sort parameter
+    header, body = build_search_body(
+        {'query': {'match_all': {}}}, 'default',
+        {'es_sort': 'date:desc,_score', 'es_from': 20})
+
+    # Then I see the parameters in the body with the sort translated
+    header.should.equal({'index': 'default'})
+    body.should.equal({
+        'query': {'match_all': {}},
+        'sort': [{'date': 'desc'}, '_score'],
+        'from': 20,
+    })
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_iter_all_scrolls_over_every_hit(pyelasticsearch):
+    # Given that I have a queryset
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    # And that the cluster returns two batches of hits, and an empty one
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.search.return_value = {
+        '_scroll_id': 'id1', 'hits': {'hits': ['hit1', 'hit2']}}
+    esinst.send_request.side_effect = [
+        {'_scroll_id': 'id2', 'hits': {'hits': ['hit3']}},
+        {'_scroll_id': 'id3', 'hits': {'hits': []}},
+        {},
+    ]
+
+    # When I iterate over all the results
+    items = list(queryset.iter_all(Query('ice'), batch_size=2, scroll='5m'))
+
+    # Then I see that all the batches were fetched
+    items.should.equal(['hit1', 'hit2', 'hit3'])
+    esinst.search.assert_called_once_with(
+        '"ice"', index='default', es_scroll='5m', es_size=2)
+    esinst.send_request.call_args_list.should.equal([
+        call('GET', ['_search', 'scroll'], 'id1', {'scroll': '5m'}),
+        call('GET', ['_search', 'scroll'], 'id2', {'scroll': '5m'}),
+        call('DELETE', ['_search', 'scroll', 'id3']),
+    ])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_iter_all_wraps_each_batch(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+
+    hit1 = {'_type': 'type1', '_id': '1'}
+    hit2 = {'_type': 'type1', '_id': '2'}
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.search.return_value = {'_scroll_id': 'id', 'hits': {'hits': [hit1]}}
+    esinst.send_request.side_effect = [
+        {'_scroll_id': 'id', 'hits': {'hits': [hit2]}},
+        {'_scroll_id': 'id', 'hits': {'hits': []}},
+        {},
+    ]
+
+    # Given that I have a wrapper
+    wrapper = Mock()
+    wrapper.match.return_value = True
+    wrapper.get_key = Wrapper.get_key
+    wrapper.wrap.side_effect = lambda objs: objs
+
+    # When I iterate over all the results
+    items = list(QuerySet(conf=conf).wrap(wrapper).iter_all('stuff'))
+
+    # Then I see that the wrapper was called once per batch
+    items.should.equal([hit1, hit2])
+    wrapper.wrap.call_args_list.should.equal([call([hit1]), call([hit2])])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_iter_all_clears_the_scroll_when_closed(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.search.return_value = {'_scroll_id': 'id1', 'hits': {'hits': ['hit1']}}
+
+    # When I stop consuming the generator before its end
+    items = QuerySet(conf=conf).iter_all('stuff')
+    next(items).should.equal('hit1')
+    items.close()
+
+    # Then I see that the scroll was cleared
+    esinst.send_request.assert_called_once_with(
+        'DELETE', ['_search', 'scroll', 'id1'])
+
+
+def test_iter_all_against_an_invalid_index():
+    conf = Mock(indexes=['default'])
+    queryset = QuerySet(conf=conf)
+
+    queryset.iter_all.when.called_with('a', index='blah').should.throw(
+        ImproperlyConfigured,
+        "There's no index called `blah`, the available ones are: default.")
+
+
+def test_get_items_dispatch_by_doc_types():
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'deal', '_id': '2'}
+    hit3 = {'_type': 'user', '_id': '3'}
+    queryset.raw_results = {'hits': {'hits': [hit1, hit2, hit3]}}
+
+    # Given that I have wrappers declaring the types they handle
+    users = Mock(doc_types=('user',), get_key=Wrapper.get_key)
+    users.wrap.side_effect = lambda objs: objs
+    deals = Mock(doc_types=('deal',), get_key=Wrapper.get_key)
+    deals.wrap.side_effect = lambda objs: objs
+
+    # When I get the items
+    results = queryset.wrap(users).wrap(deals).items()
+
+    # Then I see that the hits were routed by their types, without
+    # calling the `match()` method
+    results.should.equal([hit1, hit2, hit3])
+    users.wrap.assert_called_once_with([hit1, hit3])
+    deals.wrap.assert_called_once_with([hit2])
+    users.match.called.should.be.false
+    deals.match.called.should.be.false
+
+
+def test_get_items_first_matching_wrapper_wins():
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    hit1 = {'_type': 'type1', '_id': '1'}
+    hit2 = {'_type': 'type2', '_id': '2'}
+    queryset.raw_results = {'hits': {'hits': [hit1, hit2]}}
+
+    # Given that I have a wrapper that matches everything, registered
+    # before a wrapper declaring its types
+    everything = Wrapper()
+    everything.match = lambda obj: obj['_id'] == '1'
+    everything.wrap = Mock(side_effect=lambda objs: objs)
+
+    typed = Wrapper()
+    typed.doc_types = ('type1', 'type2')
+    typed.wrap = Mock(side_effect=lambda objs: objs)
+
+    # When I get the items
+    queryset.wrap(everything).wrap(typed).items()
+
+    # Then I see that each hit was wrapped only once, by the first
+    # wrapper that took it
+    everything.wrap.assert_called_once_with([hit1])
+    typed.wrap.assert_called_once_with([hit2])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_searching_with_filters(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    # When I search passing a filter
+    queryset.search(Query('ice'), filter=Query(category='food') & Query(active=True))
+
+    # Then I see that the filter was compiled to the DSL and sent in the
+    # filter context of the search
+    pyelasticsearch.ElasticSearch.return_value.search.assert_called_once_with({
+        'query': {'bool': {
+            'must': {'query_string': {'query': '"ice"'}},
+            'filter': {'bool': {'must': [
+                {'term': {'category': 'food'}},
+                {'term': {'active': True}},
+            ]}},
+        }},
+    }, index='default')
+
+
+def test_search_query_with_filters():
+    # When there's no query, Then I see that everything is matched
+    search_query(None, filter={'term': {'a': 1}}).should.equal({
+        'query': {'bool': {'must': {'match_all': {}}, 'filter': {'term': {'a': 1}}}}})
+    search_query(Query.empty(), filter=Query(a=1)).should.equal({
+        'query': {'bool': {'must': {'match_all': {}}, 'filter': {'term': {'a': 1}}}}})
+
+    # And when the query is a dict, Then I see that it's kept in the body
+    search_query({'query': {'match': {'a': 'b'}}, 'size': 5}, filter=Query(a=1)).should.equal({
+        'query': {'bool': {'must': {'match': {'a': 'b'}}, 'filter': {'term': {'a': 1}}}},
+        'size': 5,
+    })
+
+
+def test_build_search_body_with_filters():
+    header, body = build_search_body('stuff', 'default', {'filter': Query(a=1)})
+
+    body.should.equal({'query': {'bool': {
+        'must': {'query_string': {'query': 'stuff'}},
+        'filter': {'term': {'a': 1}},
+    }}})
+
+
+def test_iter_items_wraps_in_chunks():
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+
+    hits = [{'_type': 'type1', '_id': str(i)} for i in range(5)]
+    queryset.raw_results = {'hits': {'hits': hits}}
+
+    # Given that I have a wrapper that loses the third hit
+    wrapper = Mock(get_key=Wrapper.get_key)
+    wrapper.match.return_value = True
+    wrapper.wrap.side_effect = lambda objs: [o for o in objs if o['_id'] != '2']
+    queryset.wrap(wrapper)
+
+    # When I iterate over the items in chunks of two hits
+    items = queryset.iter_items(chunk_size=2)
+
+    # Then I see that the first chunk is wrapped before the others
+    next(items).should.equal(hits[0])
+    wrapper.wrap.call_args_list.should.equal([call(hits[0:2])])
+
+    # And I see that the order and the cleaning of the results are the
+    # same as `items()`
+    list(items).should.equal([hits[1], hits[3], hits[4]])
+    wrapper.wrap.call_args_list.should.equal(
+        [call(hits[0:2]), call(hits[2:4]), call(hits[4:])])
+    list(queryset.iter_items(chunk_size=2, clean=False)).should.equal(
+        queryset.items(clean=False))
+
+
+def test_iter_items_without_wrappers():
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    queryset = QuerySet(conf=conf)
+    queryset.raw_results = {'hits': {'hits': ['hit1', 'hit2', 'hit3']}}
+
+    list(queryset.iter_items(chunk_size=2)).should.equal(['hit1', 'hit2', 'hit3'])
+
+
+def test_iter_items_without_searching_before():
+    conf = Mock(indexes=['default'])
+    QuerySet(conf=conf).iter_items.when.called_with().should.throw(
+        EmptyQuerySetException)
+
+
+def test_get_items_with_an_executor_wraps_concurrently():
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'deal', '_id': '2'}
+    hit3 = {'_type': 'user', '_id': '3'}
+
+    # Given that I have two wrappers that can only finish when both of
+    # them are running at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wrap(objs):
+        barrier.wait()
+        return iter(objs)
+
+    users = Wrapper()
+    users.doc_types = ('user',)
+    users.wrap = wrap
+    deals = Wrapper()
+    deals.doc_types = ('deal',)
+    deals.wrap = wrap
+
+    # When I get the items of a queryset with an executor
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        queryset = QuerySet(conf=conf, executor=executor)
+        queryset.raw_results = {'hits': {'hits': [hit1, hit2, hit3]}}
+        results = queryset.wrap(users).wrap(deals).items()
+
+    # Then I see that the results were merged back in order
+    results.should.equal([hit1, hit2, hit3])
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_a_cache(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'},
+        'deals': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {'hits': {'total': 1, 'hits': ['hit1']}}
+
+    # Given that I have a queryset with a search cache
+    cache = SearchCache(ttl=60)
+    queryset = QuerySet(conf=conf, cache=cache)
+
+    # When I run the same search twice, with the kwargs in different orders
+    queryset.search(Query('ice'), es_size=10, es_from=0)
+    queryset.search(Query('ice'), es_from=0, es_size=10)
+
+    # Then I see that the cluster was called only once
+    search.call_count.should.equal(1)
+    queryset.items().should.equal(['hit1'])
+
+    # And I see that different parameters or indexes are different searches
+    queryset.search(Query('ice'), es_size=20, es_from=0)
+    queryset.search(Query('ice'), index='deals', es_size=10, es_from=0)
+    search.call_count.should.equal(3)
+
+    # And I see that invalidating an index only drops its own searches
+    cache.invalidate('deals')
+    queryset.search(Query('ice'), es_size=10, es_from=0)
+    queryset.search(Query('ice'), index='deals', es_size=10, es_from=0)
+    search.call_count.should.equal(4)
+
+
+@patch('elasticfun.cache.time')
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_a_cache_revalidates_stale_results(pyelasticsearch, time):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {'hits': {'total': 1, 'hits': ['old']}}
+
+    # Given that I have a cached search that became stale
+    time.time.return_value = 100
+    cache = SearchCache(ttl=10, stale_ttl=30)
+    QuerySet(conf=conf, cache=cache).search('ice')
+    time.time.return_value = 115
+    search.return_value = {'hits': {'total': 1, 'hits': ['new']}}
+
+    # When I search again
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        queryset = QuerySet(conf=conf, executor=executor, cache=cache)
+        queryset.search('ice')
+
+    # Then I see that I got the stale results right away, while the
+    # cache was refreshed in the background
+    queryset.items().should.equal(['old'])
+    search.call_count.should.equal(2)
+    queryset.search('ice').items().should.equal(['new'])
+
+    # And I see that results are dropped after the stale period
+    time.time.return_value = 200
+    queryset.search('ice')
+    search.call_count.should.equal(3)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_a_cache_invalidated_while_searching(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    cache = SearchCache(ttl=60)
+
+    # Given that the index is invalidated while a search is in flight
+    def search(*args, **kwargs):
+        cache.invalidate('default')
+        return {'hits': {'total': 1, 'hits': ['old']}}
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.search.side_effect = search
+    QuerySet(conf=conf, cache=cache).search('ice')
+
+    # When I search again
+    esinst.search.side_effect = None
+    esinst.search.return_value = {'hits': {'total': 1, 'hits': ['new']}}
+    queryset = QuerySet(conf=conf, cache=cache).search('ice')
+
+    # Then I see that the response older than the invalidation wasn't
+    # served from the cache
+    queryset.items().should.equal(['new'])
+    esinst.search.call_count.should.equal(2)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_singleflight_shares_concurrent_requests(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+
+    # Given that the cluster only answers when we tell it to
+    started, release = threading.Event(), threading.Event()
+    waiting = threading.Semaphore(0)
+
+    def search(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return {'hits': {'total': 1, 'hits': ['hit1']}}
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.search.side_effect = search
+
+    class WaitingCall(_Call):
+        def wait(self):
+            waiting.release()
+            return super(WaitingCall, self).wait()
+
+    # When many threads run the same search through a single flight
+    singleflight = SingleFlight()
+    results = []
+
+    def run():
+        queryset = QuerySet(conf=conf, singleflight=singleflight)
+        results.append(queryset.search(Query('ice'), es_size=10).items())
+
+    with patch('elasticfun.singleflight._Call', WaitingCall):
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        for _ in threads[1:]:
+            waiting.acquire(timeout=5)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    # Then I see that the cluster got a single request and every thread
+    # got its response
+    esinst.search.call_count.should.equal(1)
+    results.should.equal([['hit1']] * 4)
+
+    # And I see that searches made afterwards reach the cluster again
+    QuerySet(conf=conf, singleflight=singleflight).search(Query('ice'), es_size=10)
+    esinst.search.call_count.should.equal(2)
+
+
+def test_singleflight_forgets_failed_calls():
+    singleflight = SingleFlight()
+
+    def fail():
+        raise ElasticHttpError(500, 'boom')
+
+    # When the call fails, Then I see the exception
+    singleflight.do.when.called_with('key', fail).should.throw(ElasticHttpError)
+    singleflight._calls.should.equal({})
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_source_filtering(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+
+    # When I ask for some fields only, Then I see that they're sent as
+    # `_source` filters
+    QuerySet(conf=conf).only('name', 'email').defer('bio').search('q')
+    search.assert_called_with(
+        'q', index='default',
+        es__source_include=['name', 'email'], es__source_exclude=['bio'])
+
+    # And I see that asking for the ids only doesn't fetch the `_source`
+    QuerySet(conf=conf).ids_only().search('q', es_size=10)
+    search.assert_called_with(
+        'q', index='default', es__source=False, es_size=10)
+
+    # And I see that the kwargs of the search win
+    QuerySet(conf=conf).ids_only().search('q', es__source=True)
+    search.assert_called_with('q', index='default', es__source=True)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_the_fields_declared_by_the_wrappers(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+
+    users, deals, others = Wrapper(), Wrapper(), Wrapper()
+    users.source_fields = ('name',)
+    deals.source_fields = ('name', 'price')
+
+    # When all the wrappers declare their fields, Then I see that only
+    # those fields are fetched
+    QuerySet(conf=conf).wrap(users).wrap(deals).search('q')
+    search.assert_called_with(
+        'q', index='default', es__source_include=['name', 'price'])
+
+    # And I see that wrappers needing the ids only skip the `_source`
+    users.source_fields = ()
+    QuerySet(conf=conf).wrap(users).search('q')
+    search.assert_called_with('q', index='default', es__source=False)
+
+    # And I see that the whole documents are fetched when a wrapper
+    # doesn't declare its fields
+    QuerySet(conf=conf).wrap(users).wrap(others).search('q')
+    search.assert_called_with('q', index='default')
+
+
+def test_build_search_body_with_source_filtering():
+    header, body = build_search_body('q', 'default', {
+        'es__source_include': 'name,email', 'es__source_exclude': ['bio']})
+
+    body.should.equal({
+        'query': {'query_string': {'query': 'q'}},
+        '_source': {'include': ['name', 'email'], 'exclude': ['bio']},
+    })
+    build_search_body('q', 'default', {'es__source': False})[1]['_source'] \
+        .should.be.false
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_with_aggregations(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {
+        'hits': {'total': 13, 'hits': []},
+        'aggregations': {'tags': {'buckets': [{'key': 'ice', 'doc_count': 13}]}},
+    }
+
+    # When I search with an aggregation and no hits
+    queryset = QuerySet(conf=conf).ids_only().aggregate('tags', terms='tags', size=5)
+    queryset.search(Query('ice'), es_size=0)
+
+    # Then I see that it went in the same request, in the body
+    search.assert_called_once_with({
+        'query': {'query_string': {'query': '"ice"'}},
+        'aggs': {'tags': {'terms': {'field': 'tags', 'size': 5}}},
+    }, index='default', es_size=0)
+
+    # And I see the count and the parsed aggregation
+    queryset.count().should.equal(13)
+    queryset.aggregations['tags'].counts().should.equal({'ice': 13})
+
+
+def test_build_search_body_with_aggregations():
+    aggs = {'tags': {'terms': {'field': 'tags'}}}
+    header, body = build_search_body({'query': {'match_all': {}}}, 'default', {
+        'aggs': aggs, 'es_size': 0})
+
+    body.should.equal({'query': {'match_all': {}}, 'aggs': aggs, 'size': 0})
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_count_with_a_query_uses_the_count_endpoint(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.count.return_value = {'count': 42}
+
+    # When I count the documents matching a query
+    queryset = QuerySet(conf=conf)
+    queryset.count(Query('ice'), filter=Query(tags='food')).should.equal(42)
+
+    # Then I see that the `_count` endpoint was used and no search was made
+    esinst.count.assert_called_once_with({
+        'query': {'bool': {
+            'must': {'query_string': {'query': '"ice"'}},
+            'filter': {'term': {'tags': 'food'}},
+        }},
+    }, index='default')
+    esinst.search.called.should.be.false
+    queryset.raw_results.should.be.none
+
+    # And I see that counting everything matches all the documents
+    queryset.count(None)
+    esinst.count.assert_called_with({'query': {'match_all': {}}}, index='default')
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_search_count_only(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {'hits': {'total': 7, 'hits': []}}
+
+    # When I search asking for the count only
+    queryset = QuerySet(conf=conf).only('name').search('ice', count_only=True)
+
+    # Then I see that no hits were requested
+    search.assert_called_once_with('ice', index='default', es_size=0)
+    queryset.count().should.equal(7)
+    queryset.items().should.equal([])
+
+
+def test_count_against_an_invalid_index():
+    conf = Mock(indexes=['default'])
+    QuerySet(conf=conf).count.when.called_with('ice', index='nope').should.throw(
+        ImproperlyConfigured)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_lazy_querysets_run_once_with_the_final_window(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'},
+        'deals': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {'hits': {'total': 30, 'hits': ['hit1', 'hit2']}}
+
+    # Given that I build a search step by step
+    queryset = QuerySet(conf=conf).using('deals').query(Query('ice')) \
+        .filter(Query(tags='food'), price__lt=10).exclude(status='closed') \
+        .order_by('-created', 'name')
+    page = queryset[10:30][:5]
+
+    # Then I see that nothing was sent yet
+    search.called.should.be.false
+
+    # When I go through the results a few times
+    list(page).should.equal(['hit1', 'hit2'])
+    len(page).should.equal(2)
+    page[1].should.equal('hit2')
+
+    # Then I see that a single search was made, with the final window
+    search.assert_called_once_with({
+        'query': {'bool': {
+            'must': {'query_string': {'query': '"ice"'}},
+            'filter': {'bool': {'must': [
+                {'term': {'tags': 'food'}},
+                {'range': {'price': {'lt': 10}}},
+                {'bool': {'must_not': [{'term': {'status': 'closed'}}]}},
+            ]}},
+        }},
+    }, index='deals', es_sort='created:desc,name', es_from=10, es_size=5)
+
+    # And I see that the original queryset didn't change
+    queryset._window.should.equal((0, None))
+    queryset.raw_results.should.be.none
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_lazy_querysets_count_without_fetching_hits(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.count.return_value = {'count': 3}
+
+    # When I count the results of a lazy queryset that didn't run
+    queryset = QuerySet(conf=conf).filter(tags='food')
+    queryset.count().should.equal(3)
+
+    # Then I see that no hits were fetched
+    esinst.search.called.should.be.false
+    esinst.count.assert_called_once_with({'query': {'bool': {
+        'must': {'match_all': {}}, 'filter': {'term': {'tags': 'food'}}}}},
+        index='default')
+
+
+def test_lazy_querysets_slicing_errors():
+    conf = Mock(indexes=['default'])
+    queryset = QuerySet(conf=conf)
+
+    queryset.__getitem__.when.called_with(-1).should.throw(
+        ValueError, 'Negative indexing is not supported.')
+    queryset.__getitem__.when.called_with(slice(0, 10, 2)).should.throw(ValueError)
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_slicing_a_queryset_that_already_searched(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    search = pyelasticsearch.ElasticSearch.return_value.search
+    search.return_value = {'hits': {'total': 3, 'hits': ['hit1', 'hit2', 'hit3']}}
+
+    # When I slice a queryset after searching
+    queryset = QuerySet(conf=conf).search('ice')
+
+    # Then I see the results of that search, with no new requests
+    queryset[0].should.equal('hit1')
+    queryset[1:].should.equal(['hit2', 'hit3'])
+    search.call_count.should.equal(1)
+
+
+def test_lazy_querysets_filter_and_exclude_with_many_lookups():
+    conf = Mock(indexes=['default'])
+
+    # When I filter and exclude with more than one lookup at once
+    queryset = QuerySet(conf=conf) \
+        .filter(tags='food', price__lt=10).exclude(status='closed', private=True)
+
+    # Then I see each lookup became a query, and that only the results
+    # matching all the excluded ones are left out
+    queryset._lazy_search()[2].to_dsl().should.equal({'bool': {'must': [
+        {'range': {'price': {'lt': 10}}},
+        {'term': {'tags': 'food'}},
+        {'bool': {'must_not': [{'bool': {'must': [
+            {'term': {'private': True}},
+            {'term': {'status': 'closed'}},
+        ]}}]}},
+    ]}})
+
+
+def test_querysets_truthiness():
+    conf = Mock(indexes=['default'])
+
+    # Given a queryset that didn't search, which is true as it always was
+    bool(QuerySet(conf=conf)).should.be.true
+
+    # When it becomes lazy, its truth comes from its results
+    queryset = QuerySet(conf=conf).filter(tags='food')
+    queryset._result_cache = []
+    bool(queryset).should.be.false
+
+
+@patch('elasticfun.connections._registry', None)
+@patch('elasticfun.connections.pyelasticsearch')
+def test_msearch_with_aggregations_keeps_the_kwargs_given(pyelasticsearch):
+    connections = {
+        'default': {'URL': 'http://localhost:9200'}}
+    conf = Mock(connections=connections, indexes=connections.keys())
+    esinst = pyelasticsearch.ElasticSearch.return_value
+    esinst.send_request.return_value = {'responses': [{'hits': {'hits': []}}]}
+
+    # When I run a search with aggregations through msearch()
+    kwargs = {'es_size': 5}
+    QuerySet(conf=conf).aggregate('tags', terms='tags').msearch([
+        (Query('ice'), 'default', kwargs)])
+
+    # Then I see that the aggregations were sent, and the kwargs I gave
+    # didn't change
+    body = esinst.send_request.call_args[0][2]
+    json.loads(body.splitlines()[1])['aggs'].should.equal(
+        {'tags': {'terms': {'field': 'tags'}}})
+    kwargs.should.equal({'es_size': 5})
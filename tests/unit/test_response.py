@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+
+from mock import patch
+
+from elasticfun.response import Hit, lazy_loads, loads, simdjson
+
+
+RESPONSE = {
+    'took': 3,
+    'hits': {
+        'total': 2,
+        'max_score': 1.0,
+        'hits': [
+            {'_type': 'user', '_id': '1', '_source': {'name': 'Lincoln', 'tags': ['a']}},
+            {'_type': 'deal', '_id': '2', '_source': {'hits': [1, 2]}},
+        ],
+    },
+    'facets': {'tags': {'terms': [{'term': 'a', 'count': 1}]}},
+}
+
+
+def test_loads():
+    data = json.dumps(RESPONSE).encode('utf-8')
+
+    loads(data).should.equal(RESPONSE)
+    loads(data.decode('utf-8')).should.equal(RESPONSE)
+
+
+@patch('elasticfun.response.orjson', None)
+def test_loads_without_orjson():
+    loads(json.dumps(RESPONSE).encode('utf-8')).should.equal(RESPONSE)
+
+
+@patch('elasticfun.response.simdjson', None)
+def test_lazy_loads_without_simdjson():
+    # When simdjson is not installed, Then I see that the response is
+    # decoded right away
+    response = lazy_loads(json.dumps(RESPONSE))
+    response.should.equal(RESPONSE)
+    response['hits']['hits'][0].should.be.a(dict)
+
+
+def test_lazy_loads():
+    if simdjson is None:
+        return
+
+    # When I decode a response lazily
+    response = lazy_loads(json.dumps(RESPONSE).encode('utf-8'))
+
+    # Then I see that the hits are views, that decode their fields only
+    # when they're used
+    response['facets'].should.be.a(dict)
+    hit = response['hits']['hits'][0]
+    hit.should.be.a(Hit)
+    hit['_id'].should.equal('1')
+    hit.get('_type').should.equal('user')
+    ('_source' in hit).should.be.true
+    hit._values.should.equal({'_id': '1', '_type': 'user'})
+    hit['_source'].should.equal({'name': 'Lincoln', 'tags': ['a']})
+
+    # And I see that the response looks just like the regular one
+    response.should.equal(RESPONSE)
+
+    # And I see that pickled hits become regular dicts
+    pickle.loads(pickle.dumps(hit)).should.equal(RESPONSE['hits']['hits'][0])
@@ -36,3 +36,53 @@ def test_user_input_two_words_or():
     query = Query.from_user_input('ice cream', default_op='OR')
 
     str(query).should.equal('("ice" OR "cream")')
+
+
+def test_user_input_many_words_in_a_single_group():
+    query = Query.from_user_input('ice cream cone')
+
+    str(query).should.equal('("ice" AND "cream" AND "cone")')
+    query.children.should.have.length_of(3)
+
+
+def test_user_input_phrases():
+    query = Query.from_user_input('"ice cream" cone')
+
+    str(query).should.equal('("ice cream" AND "cone")')
+
+
+def test_user_input_unterminated_phrase():
+    query = Query.from_user_input('cone "ice cream')
+
+    str(query).should.equal('("cone" AND "ice cream")')
+
+
+def test_user_input_required_and_excluded_terms():
+    query = Query.from_user_input('+ice cream -"cone"', default_op='OR')
+
+    str(query).should.equal('("ice" AND "cream" AND (NOT "cone"))')
+
+
+def test_user_input_only_excluded_terms():
+    query = Query.from_user_input('-cone')
+
+    str(query).should.equal('(*:* AND (NOT "cone"))')
+
+
+def test_user_input_or_binds_to_the_surrounding_words():
+    query = Query.from_user_input('ice cream OR yogurt cone')
+
+    str(query).should.equal('("ice" AND ("cream" OR "yogurt") AND "cone")')
+
+
+def test_user_input_dangling_operators():
+    str(Query.from_user_input('OR ice OR')).should.equal('"ice"')
+    str(Query.from_user_input('ice - cream')).should.equal(
+        '("ice" AND "\\-" AND "cream")')
+
+
+def test_user_input_allowed_fields():
+    query = Query.from_user_input(
+        'category:"sport wear" brand:acme', fields=('category',))
+
+    str(query).should.equal('(category:"sport wear" AND "brand\\:acme")')
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-from elasticfun import Wrapper
+from mock import Mock
+
+from elasticfun import CachedWrapper, QuerySet, Wrapper
+from elasticfun.cache import LRUCache
 
 
 def test_wrapper_get_key():
@@ -21,3 +24,83 @@ def test_wrapper_wrap():
     hit1 = {'_type': 'type1', '_id': 'some_id', 'value': 'hit1'}
 
     Wrapper.wrap.when.called_with(hit1).should.throw(NotImplementedError)
+
+
+class UserWrapper(Wrapper):
+    doc_types = ('user',)
+    calls = []
+
+    @classmethod
+    def wrap(cls, objs):
+        cls.calls.append(objs)
+        return [dict(obj, wrapped=True) for obj in objs]
+
+
+def test_cached_wrapper_only_wraps_the_misses():
+    UserWrapper.calls = []
+    hit1 = {'_type': 'user', '_id': '1', '_version': 1}
+    hit2 = {'_type': 'user', '_id': '2', '_version': 1}
+
+    # Given that I have a cached wrapper that already wrapped a hit
+    wrapper = CachedWrapper(UserWrapper, backend=LRUCache())
+    wrapper.wrap([hit1])
+
+    # When I wrap that hit again with a new one
+    results = wrapper.wrap([hit1, hit2])
+
+    # Then I see that only the new hit was passed to the real wrapper
+    UserWrapper.calls.should.equal([[hit1], [hit2]])
+    sorted(results, key=lambda obj: obj['_id']).should.equal([
+        dict(hit1, wrapped=True), dict(hit2, wrapped=True)])
+
+    # And I see that the cached wrapper works like the original one
+    wrapper.doc_types.should.equal(('user',))
+    wrapper.source_fields.should.be.none
+    wrapper.get_key(hit1).should.equal('user:1')
+
+
+def test_cached_wrapper_invalidation_by_version():
+    UserWrapper.calls = []
+    wrapper = CachedWrapper(UserWrapper, backend=LRUCache())
+    wrapper.wrap([{'_type': 'user', '_id': '1', '_version': 1}])
+
+    # When the document gets a new version, Then I see that it's wrapped
+    # again
+    wrapper.wrap([{'_type': 'user', '_id': '1', '_version': 2}])
+    UserWrapper.calls.should.have.length_of(2)
+
+
+def test_cached_wrapper_with_a_version_hook_and_invalidate():
+    UserWrapper.calls = []
+    hit = {'_type': 'user', '_id': '1', '_source': {'updated': 'today'}}
+
+    # Given that I have a cached wrapper using a field of the document as
+    # its version
+    wrapper = CachedWrapper(
+        UserWrapper, backend=LRUCache(),
+        version=lambda hit: hit['_source']['updated'])
+    wrapper.wrap([hit])
+    wrapper.cache_key(hit).should.equal('elasticfun:user:1:today')
+
+    # When I invalidate the hit, Then I see that it's wrapped again
+    wrapper.invalidate(hit)
+    wrapper.wrap([hit])
+    UserWrapper.calls.should.equal([[hit], [hit]])
+
+
+def test_cached_wrapper_with_a_queryset():
+    UserWrapper.calls = []
+    conf = Mock(indexes=['default'])
+    hit1 = {'_type': 'user', '_id': '1'}
+    hit2 = {'_type': 'user', '_id': '2'}
+
+    wrapper = CachedWrapper(UserWrapper, backend=LRUCache())
+    wrapper.wrap([hit2])
+
+    # When I use a cached wrapper in a queryset
+    queryset = QuerySet(conf=conf).wrap(wrapper)
+    queryset.raw_results = {'hits': {'hits': [hit1, hit2]}}
+
+    # Then I see that the cached objects are kept in order
+    queryset.items().should.equal([
+        dict(hit1, wrapped=True), dict(hit2, wrapped=True)])